@@ -6,12 +6,1775 @@ from tqdm import tqdm
 import numpy as np
 import multiprocessing
 from MDAnalysis.lib import distances
-import collections
 from multiprocessing import Pool, Lock
+from concurrent.futures import ThreadPoolExecutor
 import MDAnalysis as mda
-import pickle
-import glob
-from basicrta import istarmap
+import io
+import json
+import hashlib
+import bisect
+import re
+import shutil
+import tempfile
+import queue
+from contextlib import ExitStack
+import threading
+import time as timer
+import zlib
+import functools
+from numpy.lib.format import open_memmap
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+# one row per residue pair in contact in a frame of one of the replicas
+contact_dtype = np.dtype([('frame', np.int32), ('presid', np.int32),
+                          ('lresid', np.int32), ('distance', np.float32),
+                          ('time', np.float32), ('replica', np.int16)])
+# one row per residence event, starting at `frame` and lasting `nframes`
+event_dtype = np.dtype([('presid', np.int32), ('lresid', np.int32),
+                        ('frame', np.int32), ('time', np.float32),
+                        ('nframes', np.int32), ('replica', np.int16)])
+# the frames `word`*64 to `word`*64 + 63, relative to the first frame of the
+# map, a residue pair is in contact, as the bits of `bits` from the lowest
+bits_dtype = np.dtype([('presid', np.int32), ('lresid', np.int32),
+                       ('word', np.int32), ('bits', np.uint64)])
+# one row per residue of the first group, summarizing its contacts, with
+# `contact_time` derived from the exact count of residue pairs `ncontacts`
+stats_dtype = np.dtype([('presid', np.int32), ('nevents', np.int32),
+                        ('nframes', np.int32), ('ncontacts', np.int64),
+                        ('contact_time', np.float32),
+                        ('occupancy', np.float32)])
+
+
+def _metadata_name(map_name):
+    return f'{os.path.splitext(map_name)[0]}.json'
+
+
+def save_metadata(map_name, metadata):
+    """
+    Save the metadata of a contact map as json next to the map itself.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param metadata: Metadata describing how the contact map was created,
+                     containing only plain python types
+    :type metadata: dict
+    """
+    with open(_metadata_name(map_name), 'w') as f:
+        json.dump(dict(metadata), f)
+
+
+def load_metadata(map_name):
+    """
+    Load the metadata saved alongside a contact map without touching the map.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    """
+    with open(_metadata_name(map_name), 'r') as f:
+        return json.load(f)
+
+
+# Universe and settings of a MapContacts worker process, see _init_worker
+_worker = {}
+
+
+def _init_worker(lock, top, traj, ag1_indices, ag2_indices, settings):
+    """
+    Open the topology and trajectory once per worker process, so that tasks
+    only need to carry the frames they analyze. `ag2_indices` holds the
+    indices of each of the second atom groups.
+    """
+    tqdm.set_lock(lock)
+    if settings['positions'] is None:
+        u, store = mda.Universe(top, traj), None
+    else:
+        u, store = mda.Universe(top), load_positions(settings['positions'])
+    _worker.update(settings, u=u, store=store, ag1=u.atoms[ag1_indices],
+                   ag2=[u.atoms[indices] for indices in ag2_indices])
+
+
+def _read_frames(frames):
+    """
+    Frame, time, positions of the first atom group and list of positions of
+    the second atom groups of each of `frames`, read from the position store
+    of the worker process if it has one and from the trajectory otherwise.
+    """
+    ag1, ag2, store = _worker['ag1'], _worker['ag2'], _worker['store']
+    if store is None:
+        for ts in _worker['u'].trajectory[frames]:
+            yield ts.frame, ts.time, ag1.positions, [ag.positions for ag in
+                                                     ag2]
+    else:
+        # the second atom groups follow each other in the store
+        bounds = np.cumsum([len(ag1)] + [len(ag) for ag in ag2])
+        for frame in frames:
+            positions = store[frame]['positions']
+            yield (frame, store[frame]['time'], positions[:len(ag1)],
+                   np.split(positions[:bounds[-1]], bounds[:-1])[1:])
+
+
+class Prefetcher(object):
+    """
+    Iterate over `iterable` while up to `depth` items ahead are produced in a
+    background thread, so that reading and decompressing the next frames
+    overlaps with computing the contacts of the current one. With a depth of
+    0 items are produced in the calling thread.
+
+    The time spent waiting for items is accumulated in :attr:`wait`.
+
+    :param iterable: Items to produce, e.g. frames read from a trajectory
+    :type iterable: iterable
+    :param depth: Number of items produced ahead of the consumer
+    :type depth: int
+    """
+
+    _done = object()
+
+    def __init__(self, iterable, depth=2):
+        self.iterable, self.depth = iterable, depth
+        self.wait = 0.0
+        self._stop = threading.Event()
+
+    def _produce(self, items):
+        try:
+            for item in self.iterable:
+                while not self._stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if self._stop.is_set():
+                    return
+            items.put((self._done, None))
+        except Exception as e:
+            items.put((self._done, e))
+
+    def __iter__(self):
+        if self.depth < 1:
+            iterator = iter(self.iterable)
+            while True:
+                start = timer.perf_counter()
+                item = next(iterator, self._done)
+                self.wait += timer.perf_counter() - start
+                if item is self._done:
+                    return
+                yield item
+
+        items = queue.Queue(maxsize=self.depth)
+        thread = threading.Thread(target=self._produce, args=(items,),
+                                  daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = timer.perf_counter()
+                item, error = items.get()
+                self.wait += timer.perf_counter() - start
+                if error is not None:
+                    raise error
+                if item is self._done:
+                    return
+                yield item
+        finally:
+            self._stop.set()
+            thread.join()
+
+
+def append_contacts(map_name, arrays):
+    """
+    Append rows to a contact map in place. The rows are written after the
+    existing data before the shape in the header is updated, so the map is
+    never left pointing at rows that were not written.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param arrays: Arrays of rows to append, with the dtype of the map
+    :type arrays: iterable of arrays
+    """
+    with open(map_name, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        else:
+            header = np.lib.format.read_array_header_2_0(f)
+        shape, fortran_order, dtype = header
+        offset = f.tell()
+
+        f.seek(offset + shape[0] * dtype.itemsize)
+        nrows = shape[0]
+        for arr in arrays:
+            f.write(np.ascontiguousarray(arr, dtype=dtype).tobytes())
+            nrows += len(arr)
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+
+        header = io.BytesIO()
+        header_data = {'descr': np.lib.format.dtype_to_descr(dtype),
+                       'fortran_order': fortran_order, 'shape': (nrows,)}
+        if version == (1, 0):
+            np.lib.format.write_array_header_1_0(header, header_data)
+        else:
+            np.lib.format.write_array_header_2_0(header, header_data)
+        if header.tell() != offset:
+            raise ValueError(f'Header of {map_name} cannot be updated in '
+                             'place')
+        f.seek(0)
+        f.write(header.getvalue())
+
+
+def merge_shards(shard_names, map_name='contacts.npy', chunksize=2**22):
+    """
+    Concatenate the contact maps of consecutive frame ranges, e.g. mapped by
+    separate cluster jobs with ``--shard``, into a single contact map. The
+    shards are copied one chunk at a time, so they never need to fit in
+    memory.
+
+    :param shard_names: Filenames of the shards (.npy), in any order
+    :type shard_names: list
+    :param map_name: Filename of the merged contact map
+    :type map_name: str
+    :param chunksize: Number of rows copied at once
+    :type chunksize: int
+    """
+    shards = sorted([(name, load_metadata(name)) for name in shard_names],
+                    key=lambda shard: shard[1]['first_frame'])
+    first_name, first = shards[0]
+    for (prev_name, prev), (name, meta) in zip(shards[:-1], shards[1:]):
+        for key in ['top', 'traj', 'ag1_indices', 'ag2_indices', 'ts',
+                    'cutoff', 'refine', 'transients']:
+            # maps from before refinement have no refine or transients
+            if meta.get(key) != first.get(key):
+                raise ValueError(f'"{key}" of {name} differs from '
+                                 f'{first_name}')
+        if meta['first_frame'] != prev['last_frame'] + 1:
+            raise ValueError(f'{prev_name} (frames {prev["first_frame"]}-'
+                             f'{prev["last_frame"]}) and {name} (frames '
+                             f'{meta["first_frame"]}-{meta["last_frame"]}) '
+                             'are not contiguous')
+
+    mapsize = sum(np.load(name, mmap_mode='r').shape[0] for name, _ in shards)
+    contact_map = open_memmap(map_name, mode='w+', shape=(mapsize,),
+                              dtype=contact_dtype)
+    j = 0
+    for name, _ in tqdm(shards, desc='merging shards'):
+        shard = np.load(name, mmap_mode='r')
+        for k in range(0, len(shard), chunksize):
+            chunk = shard[k:k + chunksize]
+            contact_map[j:j + len(chunk)] = chunk
+            j += len(chunk)
+        contact_map.flush()
+    del contact_map
+
+    metadata = dict(first, last_frame=shards[-1][1]['last_frame'])
+    save_metadata(map_name, metadata)
+    if all(os.path.exists(_stats_name(name)) for name, _ in shards):
+        stats = None
+        for name, meta in shards:
+            # events continue across shards through their first/last frames
+            shard = np.load(name, mmap_mode='r')
+            head = shard[:bisect.bisect_right(shard['frame'],
+                                              meta['first_frame'])]
+            tail = shard[bisect.bisect_left(shard['frame'],
+                                            meta['last_frame']):]
+            part = ContactStats.from_table(
+                load_stats(name), meta['ts'],
+                first=(meta['first_frame'], head['presid'], head['lresid']),
+                last=(meta['last_frame'], tail['presid'], tail['lresid']),
+                replica_starts=meta.get('replica_starts'))
+            if stats is None:
+                stats = part
+            else:
+                stats.update(part)
+        save_stats(map_name, stats.table(metadata['ts']), stats.nframes)
+    if all(os.path.exists(_occupancy_name(name)) for name, _ in shards):
+        occupancy = [np.load(_occupancy_name(name), mmap_mode='r') for name, _
+                     in shards]
+        _write_rows(_occupancy_name(map_name), occupancy,
+                    sum(len(occ) for occ in occupancy), occupancy[0].dtype)
+        save_metadata(_occupancy_name(map_name),
+                      load_metadata(_occupancy_name(first_name)))
+    print(f'\nSaved contacts as "{map_name}"')
+
+
+def scratch_dir(map_name, scratch=None):
+    """
+    Directory holding the intermediate files of a contact map while it is
+    created, inside `scratch`, e.g. node-local or in-memory storage, or next
+    to the map by default. It is named after the absolute path of the map, so
+    runs creating different maps never share it while a rerun of an
+    interrupted run finds it again.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param scratch: Directory to create the scratch directory in
+    :type scratch: str, optional
+    """
+    path = os.path.abspath(map_name)
+    key = hashlib.sha1(path.encode()).hexdigest()[:10]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(scratch or os.path.dirname(path), f'.{stem}-{key}')
+
+
+def _stats_name(map_name):
+    return f'{os.path.splitext(map_name)[0]}.stats.npy'
+
+
+def save_stats(map_name, stats, nframes):
+    """
+    Save the per-residue statistics of a contact map next to the map, as
+    <map>.stats.npy with the number of analyzed frames in <map>.stats.json.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param stats: Statistics of each residue, see :data:`stats_dtype`
+    :type stats: array
+    :param nframes: Number of frames the statistics cover
+    :type nframes: int
+    """
+    np.save(_stats_name(map_name), stats)
+    save_metadata(_stats_name(map_name), {'nframes': int(nframes)})
+
+
+def load_stats(map_name):
+    """
+    Load the per-residue statistics of a contact map, i.e. for each residue
+    of the first group the number of residence events, the number of frames
+    with any contact, the contact time summed over all partners (ns) and the
+    fraction of frames with any contact. The number of frames covered is
+    attached as ``stats.dtype.metadata['nframes']``.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    """
+    return load_contacts(_stats_name(map_name), mmap_mode=None)
+
+
+class ContactStats(object):
+    """
+    Per-residue counts of the residence events, frames in contact and
+    residue pairs in contact of consecutive frames, updated frame by frame
+    while contacts are mapped. The counts of consecutive chunks of frames are
+    combined with :meth:`update`, which joins the events continuing across the
+    boundary between the chunks.
+
+    :param resids: Sorted residue ids of the first group
+    :type resids: array
+    :param replica_starts: First frame of each replica, events never continue
+                           into these frames
+    :type replica_starts: list, optional
+    """
+
+    def __init__(self, resids, replica_starts=None):
+        self.resids = np.asarray(resids)
+        self.replica_starts = set(replica_starts or [])
+        # events, frames with any contact and contacts of each residue
+        self.counts = np.zeros((3, len(self.resids)), dtype=np.int64)
+        self.nframes = 0
+        self.first = self.last = None
+
+    @staticmethod
+    def _keys(presid, lresid):
+        return ((presid.astype(np.int64) << 32) |
+                lresid.astype(np.uint32).astype(np.int64))
+
+    def _continues(self, previous, frame):
+        return previous == frame - 1 and frame not in self.replica_starts
+
+    def _count(self, presid):
+        return np.bincount(np.searchsorted(self.resids, presid),
+                           minlength=len(self.resids))
+
+    def add(self, frame, presid, lresid):
+        """
+        Count the residue pairs in contact in `frame`, sorted by residue.
+        """
+        keys = self._keys(presid, lresid)
+        new = np.ones(len(keys), dtype=bool)
+        if self.last is not None and self._continues(self.last[0], frame):
+            new = ~np.isin(keys, self.last[1], assume_unique=True)
+        self.counts[0] += self._count(presid[new])
+        self.counts[1] += self._count(np.unique(presid))
+        self.counts[2] += self._count(presid)
+        if self.first is None:
+            self.first = (frame, keys)
+        self.last = (frame, keys)
+        self.nframes += 1
+
+    def update(self, other):
+        """
+        Add the counts of `other`, covering the frames following these.
+        """
+        self.counts += other.counts
+        if (self.last is not None and other.first is not None and
+                self._continues(self.last[0], other.first[0])):
+            keys = other.first[1]
+            joined = keys[np.isin(keys, self.last[1], assume_unique=True)]
+            self.counts[0] -= self._count(joined >> 32)
+        self.first = self.first or other.first
+        self.last = other.last or self.last
+        self.nframes += other.nframes
+
+    def save(self, name):
+        first, last = self.first or (-1, []), self.last or (-1, [])
+        np.savez(name, counts=self.counts, nframes=self.nframes,
+                 frames=[first[0], last[0]], first=first[1], last=last[1])
+
+    @classmethod
+    def load(cls, name, resids, replica_starts=None):
+        stats = cls(resids, replica_starts)
+        with np.load(name) as data:
+            stats.counts, stats.nframes = data['counts'], int(data['nframes'])
+            if stats.nframes:
+                stats.first = (int(data['frames'][0]), data['first'])
+                stats.last = (int(data['frames'][1]), data['last'])
+        return stats
+
+    @classmethod
+    def from_table(cls, table, ts, first=None, last=None,
+                   replica_starts=None):
+        """
+        Counts of a saved statistics table, with the residue pairs (frame,
+        presid, lresid) in contact in the first and last frame it covers, so
+        that it can be combined with the counts of neighboring frames.
+        """
+        stats = cls(table['presid'], replica_starts)
+        stats.counts[0] = table['nevents']
+        stats.counts[1] = table['nframes']
+        if 'ncontacts' in table.dtype.names:
+            stats.counts[2] = table['ncontacts']
+        else:
+            # tables saved before the count was stored
+            stats.counts[2] = np.round(table['contact_time'] / ts)
+        stats.nframes = table.dtype.metadata['nframes']
+        if first is not None:
+            stats.first = (first[0], cls._keys(first[1], first[2]))
+        if last is not None:
+            stats.last = (last[0], cls._keys(last[1], last[2]))
+        return stats
+
+    def table(self, ts):
+        """
+        Statistics of each residue, see :data:`stats_dtype`.
+
+        :param ts: Time between frames (ns)
+        :type ts: float
+        """
+        stats = np.zeros(len(self.resids), dtype=stats_dtype)
+        stats['presid'] = self.resids
+        stats['nevents'], stats['nframes'] = self.counts[0], self.counts[1]
+        stats['ncontacts'] = self.counts[2]
+        stats['contact_time'] = self.counts[2] * ts
+        stats['occupancy'] = self.counts[1] / max(self.nframes, 1)
+        return stats
+
+
+def _bits_name(map_name, cutoff):
+    return f'{os.path.splitext(map_name)[0]}_{float(cutoff)}.bits.npz'
+
+
+def _or_words(presid, lresid, word, bits):
+    """
+    Words sorted by lipid, residue and word, combining the bits of repeated
+    words.
+    """
+    order = np.lexsort((word, presid, lresid))
+    words = np.empty(len(order), dtype=bits_dtype)
+    words['presid'], words['lresid'] = presid[order], lresid[order]
+    words['word'], words['bits'] = word[order], bits[order]
+    if len(words) == 0:
+        return words
+    new = np.ones(len(words), dtype=bool)
+    new[1:] = ((np.diff(words['lresid']) != 0) |
+               (np.diff(words['presid']) != 0) |
+               (np.diff(words['word']) != 0))
+    starts = np.flatnonzero(new)
+    merged = words[starts]
+    merged['bits'] = np.bitwise_or.reduceat(words['bits'], starts)
+    return merged
+
+
+def _popcount(bits):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(bits)
+    return np.unpackbits(bits.astype('<u8').view(np.uint8)).reshape(
+        -1, 64).sum(axis=1)
+
+
+def _set_bits(words, masks):
+    """
+    Indices of the words with bits set in `masks`, and the frames of these
+    bits relative to the first frame of the map, in order.
+    """
+    nonzero = np.flatnonzero(masks)
+    bits = np.unpackbits(masks[nonzero].astype('<u8').view(np.uint8),
+                         bitorder='little').reshape(-1, 64)
+    rows, cols = np.nonzero(bits)
+    inds = nonzero[rows]
+    return inds, words['word'][inds].astype(np.int64) * 64 + cols
+
+
+def build_bits(map_name, cutoff, chunksize=2**22):
+    """
+    Store the contacts of a contact map within `cutoff` as one bit per frame
+    for each residue pair, in words of 64 frames, of which only those with any
+    contact are kept. A pair in contact for many consecutive frames takes a
+    64th of a row per frame, and :class:`ProcessContacts` finds the residence
+    events from the words instead of the rows of the map. The words are saved
+    as <map>_<cutoff>.bits.npz, together with the time of each frame, and the
+    metadata of the map in <map>_<cutoff>.bits.json.
+
+    Bit sets are a post-processing step of a finished map: they are only used
+    by :class:`ProcessContacts` at exactly the same cutoff, and are ignored
+    once the map is appended to, until they are built again.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param cutoff: Maximum distance of the stored contacts, at most the cutoff
+                   of the map
+    :type cutoff: float
+    :param chunksize: Number of rows of the map read at once
+    :type chunksize: int
+    """
+    contacts = load_contacts(map_name)
+    metadata = dict(contacts.dtype.metadata)
+    if cutoff > metadata['cutoff']:
+        raise ValueError(f'{map_name} only contains contacts within '
+                         f'{metadata["cutoff"]}, not {cutoff}')
+    if 'last_frame' not in metadata:
+        metadata['first_frame'] = int(contacts['frame'].min(initial=0))
+        metadata['last_frame'] = int(contacts['frame'].max(initial=-1))
+
+    # one bit per frame of the map, every `stride`th frame of a level
+    first, stride = metadata['first_frame'], metadata.get('stride', 1)
+    times = np.full((metadata['last_frame'] - first) // stride + 1, np.nan,
+                    dtype=np.float32)
+    words = []
+    for i in range(0, len(contacts), chunksize):
+        rows = contacts[i:i+chunksize]
+        rows = rows[rows['distance'] <= cutoff]
+        frames = (rows['frame'].astype(np.int64) - first) // stride
+        times[frames] = rows['time']
+        words.append(_or_words(rows['presid'], rows['lresid'], frames >> 6,
+                               np.left_shift(np.uint64(1),
+                                             (frames & 63).astype(np.uint64))))
+    # words may continue across chunks of rows
+    words = np.concatenate(words or [np.empty(0, dtype=bits_dtype)])
+    words = _or_words(words['presid'], words['lresid'], words['word'],
+                      words['bits'])
+
+    bits_name = _bits_name(map_name, cutoff)
+    np.savez(bits_name, words=words, times=times)
+    save_metadata(bits_name, dict(metadata, bits_cutoff=float(cutoff)))
+    print(f'\nSaved bit sets as "{bits_name}"')
+    return bits_name
+
+
+def load_bits(bits_name):
+    """
+    Load the words, frame times and metadata stored by :func:`build_bits`.
+
+    :param bits_name: Filename of the bit sets (.npz)
+    :type bits_name: str
+    """
+    with np.load(bits_name) as data:
+        words, times = data['words'], data['times']
+    return words, times, load_metadata(bits_name)
+
+
+def bit_events(words, times, first_frame=0, replica_starts=None, stride=1):
+    """
+    Residence events of the residue pairs stored by :func:`build_bits`, found
+    64 frames at a time: an event starts at the set bits whose preceding bit
+    is not set, and ends at the set bits whose following bit is not set, the
+    bits carrying over between consecutive words of the same pair. Events are
+    sorted by lipid, residue and frame as those of
+    :class:`ProcessContacts`.
+
+    :param words: Words of the residue pairs, see :data:`bits_dtype`
+    :type words: array
+    :param times: Time of each frame (ns)
+    :type times: array
+    :param first_frame: Frame of the first bit
+    :type first_frame: int
+    :param replica_starts: First frame of each replica, events never continue
+                           into these frames
+    :type replica_starts: list, optional
+    :param stride: Number of frames between bits, of a coarsened level
+    :type stride: int
+    """
+    bits = words['bits']
+    pairs = ContactStats._keys(words['lresid'], words['presid'])
+    # the previous word of a pair covers the 64 frames before
+    adjacent = ((pairs[1:] == pairs[:-1]) &
+                (words['word'][1:] == words['word'][:-1] + 1))
+    carry_in, carry_out = np.zeros_like(bits), np.zeros_like(bits)
+    carry_in[1:] = np.where(adjacent, bits[:-1] >> 63, 0)
+    carry_out[:-1] = np.where(adjacent, bits[1:] & 1, 0)
+
+    boundary = np.zeros(len(times) // 64 + 2, dtype=np.uint64)
+    # the first bit at or after the start of each replica
+    starts = -((first_frame - np.asarray(replica_starts or [],
+                                         dtype=np.int64)) // stride)
+    starts = starts[(starts > 0) & (starts < len(times))]
+    np.bitwise_or.at(boundary, starts >> 6,
+                     np.left_shift(np.uint64(1),
+                                   (starts & 63).astype(np.uint64)))
+    here = boundary[words['word']]
+    after = boundary[words['word'] + 1]
+
+    previous = ((bits << 1) | carry_in) & ~here
+    following = (((bits >> 1) | (carry_out << 63)) &
+                 ~((here >> 1) | (after << 63)))
+    inds, first = _set_bits(words, bits & ~previous)
+    _, last = _set_bits(words, bits & ~following)
+
+    events = np.empty(len(inds), dtype=event_dtype)
+    events['presid'] = words['presid'][inds]
+    events['lresid'] = words['lresid'][inds]
+    events['frame'] = first * stride + first_frame
+    events['time'] = times[first]
+    events['nframes'] = last - first + 1
+    events['replica'] = np.searchsorted(replica_starts or [0],
+                                        events['frame'], side='right') - 1
+    return events
+
+
+def bit_frames(words):
+    """
+    Residues of the first group with any contact and their number of frames
+    in contact with any lipid, from the words of :func:`build_bits`.
+
+    :param words: Words of the residue pairs, see :data:`bits_dtype`
+    :type words: array
+    """
+    merged = _or_words(words['presid'], np.zeros_like(words['presid']),
+                       words['word'], words['bits'])
+    presids, inds = np.unique(merged['presid'], return_inverse=True)
+    return presids, np.bincount(inds, weights=_popcount(merged['bits']),
+                                minlength=len(presids)).astype(np.int64)
+
+
+def _species_names(map_name, names):
+    """
+    Filenames of the contact maps of several named selections mapped in the
+    same pass, `map_name` itself for a single selection.
+    """
+    if len(names) == 1:
+        return [map_name]
+    stem, ext = os.path.splitext(map_name)
+    return [f'{stem}.{name}{ext}' for name in names]
+
+
+def _trajectory_files(u):
+    """
+    Filename of the trajectory of a Universe, or the list of filenames of the
+    replicas when several trajectories are chained.
+    """
+    filenames = getattr(u.trajectory, 'filenames', None)
+    if filenames is not None:
+        return list(filenames)
+    return u.trajectory.filename
+
+
+def replica_starts(u):
+    """
+    First frame of each replica of a Universe, [0] unless it was loaded from
+    a list of independent trajectories, e.g. ``mda.Universe(top, [traj1,
+    traj2])``, which are chained one after the other.
+
+    :param u: Universe containing the topology and trajectory
+    :type u: :class:`MDAnalysis.Universe`
+    """
+    readers = getattr(u.trajectory, 'readers', None)
+    lens = [len(r) for r in readers] if readers else [len(u.trajectory)]
+    return np.concatenate([[0], np.cumsum(lens)[:-1]]).astype(int).tolist()
+
+
+def _abspath(filename):
+    if isinstance(filename, (list, tuple)):
+        return [os.path.abspath(f) for f in filename]
+    return os.path.abspath(filename)
+
+
+def load_contacts(map_name, mmap_mode='r'):
+    """
+    Load a contact map as a memory-mapped array. The metadata saved alongside
+    the map is attached to the dtype of the returned array and is accessible as
+    ``contacts.dtype.metadata``.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param mmap_mode: Mode used to memory-map the array, see :func:`np.load`
+    :type mmap_mode: str
+    """
+    contacts = np.load(map_name, mmap_mode=mmap_mode)
+    metadata = load_metadata(map_name)
+    return contacts.view(np.dtype(contacts.dtype, metadata=metadata))
+
+
+# compress and decompress functions of the blocks of a compressed map
+_codecs = {'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress)}
+if blosc is not None:
+    _codecs['blosc'] = (lambda data: blosc.compress(data, typesize=4,
+                                                    cname='zstd', clevel=5),
+                        blosc.decompress)
+if zstandard is not None:
+    _codecs['zstd'] = (lambda data: zstandard.ZstdCompressor(
+        level=3).compress(data), lambda data: zstandard.ZstdDecompressor(
+        ).decompress(data))
+
+
+def _compressed_name(map_name):
+    return f'{os.path.splitext(map_name)[0]}.compressed.bin'
+
+
+def _pack(rows):
+    # one field after the other, which compresses better than whole rows
+    return b''.join(np.ascontiguousarray(rows[name]).tobytes() for name in
+                    rows.dtype.names)
+
+
+def _unpack(data, dtype, nrows):
+    rows = np.empty(nrows, dtype=dtype)
+    offset = 0
+    for name in dtype.names:
+        field = dtype.fields[name][0]
+        size = field.itemsize * nrows
+        rows[name] = np.frombuffer(data, dtype=field, count=nrows,
+                                   offset=offset)
+        offset += size
+    return rows
+
+
+def compress_contacts(map_name, codec='auto', chunksize=2**22):
+    """
+    Store a contact map, or the residence events of :class:`ProcessContacts`,
+    compressed in blocks holding the rows of a single residue of the first
+    group, with an index of the blocks of each residue, so that reading the
+    rows of one residue only decompresses its own blocks, see
+    :class:`CompressedContacts`. The blocks are written to
+    <map>.compressed.bin and the index, with the metadata of the map, to
+    <map>.compressed.json. The rows of each residue keep their order in the
+    map.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param codec: 'zstd' or 'blosc' if installed, 'zlib', or 'auto' for the
+                  first of these available
+    :type codec: str
+    :param chunksize: Number of rows of the map read at once, the largest
+                      number of rows of a block
+    :type chunksize: int
+    """
+    if codec == 'auto':
+        codec = next(name for name in ['zstd', 'blosc', 'zlib'] if name in
+                     _codecs)
+    if codec not in _codecs:
+        raise ImportError(f'The {codec} codec is not available, use one of '
+                          f'{", ".join(_codecs)}')
+    compress = _codecs[codec][0]
+
+    contacts = np.load(map_name, mmap_mode='r')
+    store_name = _compressed_name(map_name)
+    blocks, offset = [], 0
+    with open(f'{store_name}.part', 'wb') as f:
+        for i in range(0, len(contacts), chunksize):
+            rows = np.asarray(contacts[i:i+chunksize])
+            rows = rows[np.argsort(rows['presid'], kind='stable')]
+            presids, starts = np.unique(rows['presid'], return_index=True)
+            for presid, block in zip(presids, np.split(rows, starts[1:])):
+                data = compress(_pack(block))
+                f.write(data)
+                blocks.append([int(presid), offset, len(data), len(block)])
+                offset += len(data)
+    os.replace(f'{store_name}.part', store_name)
+    save_metadata(store_name, dict(
+        load_metadata(map_name), codec=codec, nrows=len(contacts),
+        descr=np.lib.format.dtype_to_descr(contacts.dtype), blocks=blocks))
+    print(f'\nSaved compressed contacts as "{store_name}"')
+    return store_name
+
+
+class CompressedContacts(object):
+    """
+    Rows of each residue of the first group of a map stored by
+    :func:`compress_contacts`.
+
+    :param store_name: Filename of the compressed map (.compressed.bin)
+    :type store_name: str
+    """
+
+    def __init__(self, store_name):
+        self.store_name = store_name
+        metadata = load_metadata(store_name)
+        blocks = np.array(metadata.pop('blocks'), dtype=np.int64).reshape(
+            -1, 4)
+        self.metadata = metadata
+        self.dtype = np.dtype(np.lib.format.descr_to_dtype(
+            metadata['descr']), metadata=metadata)
+        if metadata['codec'] not in _codecs:
+            raise ImportError(f'{store_name} was compressed with '
+                              f'{metadata["codec"]}, which is not installed')
+        self._decompress = _codecs[metadata['codec']][1]
+        order = np.argsort(blocks[:, 0], kind='stable')
+        self._blocks = blocks[order]
+        self.resids, starts = np.unique(self._blocks[:, 0],
+                                        return_index=True)
+        self._bounds = np.append(starts, len(self._blocks))
+
+    def __len__(self):
+        return int(self.metadata['nrows'])
+
+    def residue(self, presid):
+        """
+        Rows of the residue `presid`, empty if it has no rows.
+
+        :param presid: Residue id in the first group
+        :type presid: int
+        """
+        i = np.searchsorted(self.resids, presid)
+        if i == len(self.resids) or self.resids[i] != presid:
+            return np.empty(0, dtype=self.dtype)
+        blocks = self._blocks[self._bounds[i]:self._bounds[i+1]]
+        with open(self.store_name, 'rb') as f:
+            rows = []
+            for _, offset, nbytes, nrows in blocks:
+                f.seek(offset)
+                rows.append(_unpack(self._decompress(f.read(nbytes)),
+                                    self.dtype, nrows))
+        return np.concatenate(rows).view(self.dtype)
+
+
+class _MappedContacts(object):
+    """
+    Rows of each residue of the first group of an uncompressed map, with the
+    interface of :class:`CompressedContacts`.
+    """
+
+    def __init__(self, map_name):
+        self.contacts = load_contacts(map_name)
+        self.metadata = dict(self.contacts.dtype.metadata)
+        self.dtype = self.contacts.dtype
+        self.resids = np.unique(self.contacts['presid'])
+
+    def __len__(self):
+        return len(self.contacts)
+
+    def residue(self, presid):
+        return np.array(self.contacts[self.contacts['presid'] == presid])
+
+
+def _compressed_current(map_name):
+    """
+    Whether the map has a compressed copy holding the same rows, which is the
+    case of any compressed copy once the map itself is removed.
+    """
+    store_name = _compressed_name(map_name)
+    if not os.path.exists(store_name):
+        return False
+    if not os.path.exists(map_name):
+        return True
+    metadata = load_metadata(store_name)
+    if metadata['nrows'] != np.load(map_name, mmap_mode='r').shape[0]:
+        return False
+    return all(metadata.get(key) == load_metadata(map_name).get(key) for key
+               in ['first_frame', 'last_frame', 'traj', 'cutoff'])
+
+
+@functools.lru_cache(maxsize=4)
+def _open_compressed(store_name, mtime):
+    return CompressedContacts(store_name)
+
+
+def open_residues(map_name):
+    """
+    Access the rows of single residues of the first group of a contact map or
+    of the residence events of :class:`ProcessContacts`, from its compressed
+    copy if it has an up-to-date one, see :func:`compress_contacts`, and from
+    the map itself otherwise. The map may be removed once compressed.
+
+    The returned object has the residue ids with any rows as ``resids``, the
+    metadata of the map as ``metadata`` and returns the rows of a residue
+    with ``residue(presid)``.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    """
+    if _compressed_current(map_name):
+        store_name = _compressed_name(map_name)
+        return _open_compressed(store_name, os.path.getmtime(store_name))
+    return _MappedContacts(map_name)
+
+
+def position_dtype(natoms):
+    """
+    Dtype of a position store, one row per frame holding the time (ps), box
+    dimensions and positions of `natoms` atoms.
+
+    :param natoms: Number of atoms stored
+    :type natoms: int
+    """
+    return np.dtype([('time', np.float64), ('dimensions', np.float32, (6,)),
+                     ('positions', np.float32, (natoms, 3))])
+
+
+def occupancy_dtype(nres):
+    """
+    Dtype of an occupancy time series, one row per frame holding the number
+    of lipids in contact with each of `nres` residues of the first group.
+
+    :param nres: Number of residues of the first group
+    :type nres: int
+    """
+    return np.dtype([('frame', np.int32), ('nlipids', np.uint16, (nres,))])
+
+
+def _occupancy_name(map_name):
+    return f'{os.path.splitext(map_name)[0]}.occupancy.npy'
+
+
+def load_occupancy(map_name, mmap_mode='r'):
+    """
+    Load the number of lipids in contact with each residue of the first group
+    in each frame, written by :class:`MapContacts` next to the contact map as
+    <map>.occupancy.npy, see :func:`occupancy_dtype`. The residue ids of the
+    columns are attached as ``occupancy.dtype.metadata['resids']``.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param mmap_mode: Memory-map mode, see :func:`numpy.load`
+    :type mmap_mode: str, optional
+    """
+    return load_contacts(_occupancy_name(map_name), mmap_mode=mmap_mode)
+
+
+def window_dtype(nres):
+    """
+    Dtype of the occupancy of windows of frames, one row per window holding
+    its first frame, its number of frames, and for each of `nres` residues of
+    the first group the fraction of these frames with any contact and the
+    mean number of lipids in contact.
+
+    :param nres: Number of residues of the first group
+    :type nres: int
+    """
+    return np.dtype([('frame', np.int32), ('nframes', np.int32),
+                     ('occupancy', np.float32, (nres,)),
+                     ('nlipids', np.float32, (nres,))])
+
+
+def _level_name(map_name, stride):
+    stem, ext = os.path.splitext(map_name)
+    return f'{stem}.level_{stride}{ext}'
+
+
+def _windows_name(map_name, window):
+    return f'{os.path.splitext(map_name)[0]}.windows_{window}.npy'
+
+
+def build_levels(map_name, strides=(10, 100), chunksize=2**22):
+    """
+    Build coarsened copies of a contact map next to it, for quick looks such
+    as choosing a cutoff or spotting the residues with most contacts. For
+    each stride:
+
+    - <map>.level_<stride>.npy holds the rows of every `stride`th frame. It
+      is a contact map in its own right, with `stride` times the time between
+      frames as ts, which :class:`ProcessContacts` and the Gibbs sampler work
+      on directly for an approximate residence time screening.
+    - <map>.windows_<stride>.npy holds the occupancy of each window of
+      `stride` frames, see :func:`load_windows`, if the map has an occupancy
+      time series.
+
+    The map is read once for all strides, one chunk of rows at a time.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param strides: Number of frames between the frames of each level
+    :type strides: list
+    :param chunksize: Number of rows of the map read at once
+    :type chunksize: int
+    """
+    contacts = np.load(map_name, mmap_mode='r')
+    metadata = load_metadata(map_name)
+    if 'last_frame' not in metadata:
+        metadata['first_frame'] = int(contacts['frame'].min(initial=0))
+        metadata['last_frame'] = int(contacts['frame'].max(initial=-1))
+    first, last = metadata['first_frame'], metadata['last_frame']
+    # levels of a level are coarsened further
+    steps = [stride * metadata.get('stride', 1) for stride in strides]
+
+    names = [_level_name(map_name, stride) for stride in strides]
+    for name in names:
+        np.save(name, np.empty(0, dtype=contacts.dtype))
+    for i in range(0, len(contacts), chunksize):
+        rows = contacts[i:i+chunksize]
+        for name, step in zip(names, steps):
+            append_contacts(name, [rows[(rows['frame'] - first) % step == 0]])
+    for name, stride, step in zip(names, strides, steps):
+        save_metadata(name, dict(metadata, stride=step,
+                                 ts=metadata['ts'] * stride,
+                                 last_frame=first + (last - first) //
+                                 step * step))
+        print(f'\nSaved level as "{name}"')
+
+    if os.path.exists(_occupancy_name(map_name)):
+        occupancy = load_occupancy(map_name)
+        for stride, step in zip(strides, steps):
+            _save_windows(map_name, occupancy, first, stride, step)
+    return names
+
+
+def _save_windows(map_name, occupancy, first, window, step):
+    """
+    Save the occupancy of consecutive windows of `step` frames starting at
+    frame `first`.
+    """
+    frames = occupancy['frame']
+    windows, starts = np.unique((frames - first) // step, return_index=True)
+    bounds = np.append(starts, len(frames))
+    nres = len(occupancy.dtype.metadata['resids'])
+    out = np.empty(len(windows), dtype=window_dtype(nres))
+    out['frame'] = first + windows * step
+    out['nframes'] = np.diff(bounds)
+    # about 2**14 frames at a time
+    nwindows = max(1, 2**14 // step)
+    for i in range(0, len(windows), nwindows):
+        lo, hi = bounds[i], bounds[min(i + nwindows, len(windows))]
+        nlipids = np.asarray(occupancy['nlipids'][lo:hi], dtype=np.float64)
+        inds = starts[i:i + nwindows] - lo
+        sizes = out['nframes'][i:i + nwindows, None]
+        out['occupancy'][i:i + nwindows] = np.add.reduceat(
+            nlipids > 0, inds, axis=0) / sizes
+        out['nlipids'][i:i + nwindows] = np.add.reduceat(
+            nlipids, inds, axis=0) / sizes
+    name = _windows_name(map_name, window)
+    np.save(name, out)
+    save_metadata(name, dict(occupancy.dtype.metadata, window=step))
+    print(f'\nSaved window occupancy as "{name}"')
+
+
+def load_windows(map_name, window):
+    """
+    Load the occupancy of the windows of `window` frames of a contact map
+    built by :func:`build_levels`, see :func:`window_dtype`. The residue ids
+    of the columns are attached as ``windows.dtype.metadata['resids']``.
+
+    :param map_name: Filename of the contact map (.npy)
+    :type map_name: str
+    :param window: Number of frames of each window
+    :type window: int
+    """
+    return load_contacts(_windows_name(map_name, window), mmap_mode=None)
+
+
+def _write_rows(name, arrays, nrows, dtype):
+    """
+    Write consecutive arrays of rows to a new .npy file one at a time.
+    """
+    out = open_memmap(name, mode='w+', shape=(nrows,), dtype=dtype)
+    j = 0
+    for arr in arrays:
+        out[j:j + len(arr)] = arr
+        j += len(arr)
+    out.flush()
+    del out
+
+
+def extract_positions(u, ag1, ag2, store_name='positions.npy'):
+    """
+    Write the positions of only the atoms of `ag1` followed by `ag2`, along
+    with the box and time of every frame, to a memory-mappable store. The
+    trajectory is decoded once, after which :class:`MapContacts` and
+    :class:`basicrta.weighted_density.MapKinetics` can read the store instead
+    of the trajectory.
+
+    :param u: Universe loaded from a topology and trajectory file
+    :type u: `MDAnalysis.Universe`
+    :param ag1: First atom group, usually the protein
+    :type ag1: `MDAnalysis.AtomGroup`
+    :param ag2: Second atom group, usually the lipids
+    :type ag2: `MDAnalysis.AtomGroup`
+    :param store_name: Filename of the position store (.npy)
+    :type store_name: str
+    """
+    ag = ag1 + ag2
+    store = open_memmap(f'{store_name}.part', mode='w+',
+                        shape=(len(u.trajectory),),
+                        dtype=position_dtype(len(ag)))
+    for ts in tqdm(u.trajectory, desc='extracting positions'):
+        row = store[ts.frame]
+        row['time'] = ts.time
+        if ts.dimensions is not None:
+            row['dimensions'] = ts.dimensions
+        row['positions'] = ag.positions
+    store.flush()
+    del store
+    os.replace(f'{store_name}.part', store_name)
+
+    save_metadata(store_name, {'top': _abspath(u.filename),
+                               'traj': _abspath(_trajectory_files(u)),
+                               'ag1_indices': ag1.indices.tolist(),
+                               'ag2_indices': ag2.indices.tolist(),
+                               'ts': float(u.trajectory.dt/1000)})
+    print(f'\nSaved positions as "{store_name}"')
+
+
+def load_positions(store_name, mmap_mode='r'):
+    """
+    Load a position store as a memory-mapped array, with its metadata attached
+    to the dtype as with :func:`load_contacts`. Row `i` holds frame `i`, the
+    first ``len(metadata['ag1_indices'])`` positions of each row belong to the
+    first atom group.
+
+    :param store_name: Filename of the position store (.npy)
+    :type store_name: str
+    :param mmap_mode: Mode used to memory-map the array, see :func:`np.load`
+    :type mmap_mode: str
+    """
+    return load_contacts(store_name, mmap_mode=mmap_mode)
+
+
+def positions_universe(store_name):
+    """
+    Universe of only the stored atoms, in the order of the store, with the
+    stored frames as its trajectory. The trajectory reads the memory-mapped
+    store directly, so no frame is decoded.
+
+    :param store_name: Filename of the position store (.npy)
+    :type store_name: str
+    """
+    from MDAnalysis.coordinates.memory import MemoryReader
+
+    store = load_positions(store_name)
+    metadata = store.dtype.metadata
+    top = mda.Universe(metadata['top'])
+    u = mda.Merge(top.atoms[metadata['ag1_indices'] +
+                            metadata['ag2_indices']])
+    u.load_new(store['positions'], format=MemoryReader,
+               dimensions=store['dimensions'], dt=metadata['ts']*1000,
+               time_offset=float(store['time'][0]) if len(store) else 0)
+    return u
+
+
+def residue_minima(pairs, dists, rinds1, rinds2, nres2):
+    """
+    Reduce the atom pairs returned by
+    :func:`MDAnalysis.lib.distances.capped_distance` to residue pairs, keeping
+    the minimum distance of each residue pair.
+
+    :param pairs: (n, 2) array of atom indices into the two atom groups
+    :param dists: (n,) array of distances for each atom pair
+    :param rinds1: residue index of each atom in the first group
+    :param rinds2: residue index of each atom in the second group
+    :param nres2: number of residues in the second group
+    :return: residue indices into each group and the minimum distance of every
+             residue pair in contact, sorted by residue index
+    """
+    if len(pairs) == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=dists.dtype)
+
+    keys = (rinds1[pairs[:, 0]].astype(np.int64) * nres2 +
+            rinds2[pairs[:, 1]])
+    order = np.argsort(keys, kind='stable')
+    skeys = keys[order]
+    starts = np.flatnonzero(np.concatenate([[True], skeys[1:] != skeys[:-1]]))
+    mind = np.minimum.reduceat(dists[order], starts)
+    ukeys = skeys[starts]
+    return ukeys // nres2, ukeys % nres2, mind
+
+
+def _residue_minima_rows(pairs, dists, rinds1, rinds2, nres2, ures1, ures2,
+                         presid, lresid, mind):
+    """
+    Loop version of :func:`residue_minima` compiled with numba when it is
+    installed. The residue ids and minimum distance of each residue pair are
+    written directly into the preallocated `presid`, `lresid` and `mind`,
+    e.g. fields of an array of `contact_dtype` rows, and the number of rows
+    written is returned.
+
+    Instead of sorting all atom pairs, the pairs are bucketed by residue of
+    the first group, then the minima of each bucket are collected in an array
+    over the residues of the second group.
+    """
+    n, nres1 = len(dists), len(ures1)
+    starts = np.zeros(nres1 + 1, dtype=np.int64)
+    for i in range(n):
+        starts[rinds1[pairs[i, 0]] + 1] += 1
+    starts = np.cumsum(starts)
+    fill = starts[:-1].copy()
+    order = np.empty(n, dtype=np.int64)
+    for i in range(n):
+        r1 = rinds1[pairs[i, 0]]
+        order[fill[r1]] = i
+        fill[r1] += 1
+
+    best = np.full(nres2, np.inf)
+    touched = np.empty(nres2, dtype=np.int64)
+    nrows = 0
+    for r1 in range(nres1):
+        ntouched = 0
+        for j in range(starts[r1], starts[r1 + 1]):
+            i = order[j]
+            r2 = rinds2[pairs[i, 1]]
+            if best[r2] == np.inf:
+                touched[ntouched] = r2
+                ntouched += 1
+            best[r2] = min(best[r2], dists[i])
+        for r2 in np.sort(touched[:ntouched]):
+            presid[nrows] = ures1[r1]
+            lresid[nrows] = ures2[r2]
+            mind[nrows] = best[r2]
+            best[r2] = np.inf
+            nrows += 1
+    return nrows
+
+
+if njit is not None:
+    _residue_minima_rows = njit(cache=True, nogil=True)(_residue_minima_rows)
+
+
+def residue_spheres(positions, order, starts):
+    """
+    Bounding spheres of the residues of an atom group, taken as the spheres
+    around the axis-aligned bounding box of each residue.
+
+    :param positions: (n, 3) array of atom positions
+    :param order: atom indices sorted by residue index, or None if the atoms
+                  are already grouped by residue
+    :param starts: position in `order` of the first atom of each residue
+    :return: (nres, 3) array of residue centers and (nres,) array of radii
+    """
+    pos = positions if order is None else positions[order]
+    lo = np.minimum.reduceat(pos, starts, axis=0)
+    hi = np.maximum.reduceat(pos, starts, axis=0)
+    return (lo + hi) / 2, np.sqrt(((hi - lo)**2).sum(axis=1)) / 2
+
+
+class ContactSearch(object):
+    """
+    Per-frame search for the residue pairs of two atom groups that are within
+    a cutoff of each other, reporting the minimum atomic distance of each pair.
+
+    With `prefilter` the search is done in two stages. The bounding spheres of
+    the residues are compared first, and atomic distances are only computed
+    between atoms of residues whose spheres are within the cutoff of each
+    other. This skips the bulk of a membrane far away from the protein.
+
+    With `nthreads` the atoms of the second group are split into chunks that
+    are searched in separate threads, as the distance search releases the GIL.
+    This helps for very large systems with few frames, where parallelizing
+    over frames alone leaves cores idle.
+
+    With `skin` the search is reused across consecutive frames, as with a
+    Verlet list. Atom pairs within ``cutoff + skin`` are stored and only their
+    distances are computed, until an atom has moved more than half the skin
+    since the list was built, at which point the list is rebuilt.
+
+    :param resids1: Residue id of each atom in the first group
+    :type resids1: array
+    :param resids2: Residue id of each atom in the second group
+    :type resids2: array
+    :param cutoff: Distance defining a contact
+    :type cutoff: float
+    :param prefilter: Compare residue bounding spheres before atoms
+    :type prefilter: bool
+    :param skin: Extra distance of the reused neighbor list, no neighbor list
+                 is used if None
+    :type skin: float, optional
+    :param nthreads: Number of threads searching a single frame
+    :type nthreads: int
+    :param backend: Reduction of atom pairs to residue pairs, 'numpy',
+                    'numba' or 'auto' to use numba if it is installed
+    :type backend: str
+    """
+
+    def __init__(self, resids1, resids2, cutoff, prefilter=True, skin=None,
+                 nthreads=1, backend='auto'):
+        self.cutoff, self.prefilter, self.skin = cutoff, prefilter, skin
+        self.nbuilds, self._pairs = 0, None
+        self.nthreads = nthreads
+        if backend == 'auto':
+            backend = 'numpy' if njit is None else 'numba'
+        if backend not in ['numpy', 'numba']:
+            raise ValueError(f'Unknown backend "{backend}"')
+        if backend == 'numba' and njit is None:
+            raise ImportError('The numba backend requires numba to be '
+                              'installed')
+        self.backend = backend
+        self._rows = np.empty(0, dtype=contact_dtype)
+        self._executor = (ThreadPoolExecutor(nthreads) if nthreads > 1 else
+                          None)
+        self.ures1, self.rinds1 = np.unique(resids1, return_inverse=True)
+        self.ures2, self.rinds2 = np.unique(resids2, return_inverse=True)
+        self.groups1 = self._groups(self.rinds1)
+        self.groups2 = self._groups(self.rinds2)
+
+    @staticmethod
+    def _groups(rinds):
+        order = np.argsort(rinds, kind='stable')
+        srinds = rinds[order]
+        starts = np.flatnonzero(np.concatenate([[True],
+                                                srinds[1:] != srinds[:-1]]))
+        if np.array_equal(order, np.arange(len(order))):
+            order = None
+        return order, starts, np.diff(np.append(starts, len(rinds)))
+
+    @staticmethod
+    def _atoms(groups, residues):
+        order, starts, counts = groups
+        counts = counts[residues]
+        offsets = np.repeat(starts[residues] - np.cumsum(counts) + counts,
+                            counts)
+        atoms = offsets + np.arange(counts.sum())
+        return atoms if order is None else np.sort(order[atoms])
+
+    def _candidates(self, pos1, pos2, cutoff):
+        c1, r1 = residue_spheres(pos1, *self.groups1[:2])
+        c2, r2 = residue_spheres(pos2, *self.groups2[:2])
+        # lipids whose spheres reach the bounding box of the protein spheres
+        reach = cutoff + r1.max()
+        lo, hi = c1.min(axis=0) - reach, c1.max(axis=0) + reach
+        near = np.flatnonzero(((c2 + r2[:, None] >= lo) &
+                               (c2 - r2[:, None] <= hi)).all(axis=1))
+        if len(near) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty
+
+        pairs, d = distances.capped_distance(c1, c2[near],
+                                             reach + r2[near].max())
+        pairs = pairs[d <= cutoff + r1[pairs[:, 0]] +
+                      r2[near][pairs[:, 1]]]
+        return (self._atoms(self.groups1, np.unique(pairs[:, 0])),
+                self._atoms(self.groups2, near[np.unique(pairs[:, 1])]))
+
+    def _capped(self, pos1, pos2, sel1, sel2, cutoff):
+        """
+        Atom pairs of the selected atoms within the cutoff. With more than one
+        thread the atoms of the second group are split into chunks searched
+        concurrently, the per-residue minima of the pairs of all chunks are
+        then taken together by :func:`residue_minima`.
+        """
+        chunks = [sel2]
+        if self._executor is not None:
+            chunks = [chunk for chunk in np.array_split(sel2, self.nthreads)
+                      if len(chunk)]
+
+        def search(chunk):
+            pairs, dists = distances.capped_distance(pos1[sel1], pos2[chunk],
+                                                     max_cutoff=cutoff)
+            return (np.stack([sel1[pairs[:, 0]], chunk[pairs[:, 1]]], axis=1),
+                    dists)
+
+        if len(chunks) == 1:
+            return search(chunks[0])
+        results = list(self._executor.map(search, chunks))
+        return (np.concatenate([pairs for pairs, _ in results]),
+                np.concatenate([dists for _, dists in results]))
+
+    def _search(self, pos1, pos2, cutoff):
+        if self.prefilter:
+            sel1, sel2 = self._candidates(pos1, pos2, cutoff)
+            if len(sel1) == 0:
+                return np.empty((0, 2), dtype=np.int64), np.empty(0)
+        else:
+            sel1, sel2 = np.arange(len(pos1)), np.arange(len(pos2))
+        return self._capped(pos1, pos2, sel1, sel2, cutoff)
+
+    def _moved(self, pos1, pos2):
+        limit = (self.skin / 2)**2
+        return (((pos1 - self._ref1)**2).sum(axis=1).max() > limit or
+                ((pos2 - self._ref2)**2).sum(axis=1).max() > limit)
+
+    def _neighbors(self, pos1, pos2):
+        if self._pairs is None or self._moved(pos1, pos2):
+            self._pairs, _ = self._search(pos1, pos2, self.cutoff + self.skin)
+            self._ref1, self._ref2 = pos1.copy(), pos2.copy()
+            self.nbuilds += 1
+
+        pairs = self._pairs
+        dists = np.sqrt(((pos1[pairs[:, 0]].astype(np.float64) -
+                          pos2[pairs[:, 1]])**2).sum(axis=1))
+        keep = dists <= self.cutoff
+        return pairs[keep], dists[keep]
+
+    def run(self, pos1, pos2):
+        """
+        Search for contacts in a single frame.
+
+        :param pos1: Positions of the first atom group
+        :type pos1: array
+        :param pos2: Positions of the second atom group
+        :type pos2: array
+        :return: residue ids of each group and the minimum distance of every
+                 residue pair in contact
+        """
+        rows = self.rows(pos1, pos2)
+        return (rows['presid'].astype(self.ures1.dtype),
+                rows['lresid'].astype(self.ures2.dtype),
+                rows['distance'].astype(np.float64))
+
+    def rows(self, pos1, pos2):
+        """
+        Search for contacts in a single frame, writing the residue ids and
+        minimum distance of each residue pair in contact into the `presid`,
+        `lresid` and `distance` fields of a buffer of :data:`contact_dtype`
+        rows reused across frames.
+
+        :param pos1: Positions of the first atom group
+        :type pos1: array
+        :param pos2: Positions of the second atom group
+        :type pos2: array
+        :return: view of the rows of this frame, only valid until the next
+                 call
+        """
+        if self.skin:
+            pairs, dists = self._neighbors(pos1, pos2)
+        else:
+            pairs, dists = self._search(pos1, pos2, self.cutoff)
+        if len(self._rows) < len(pairs):
+            self._rows = np.empty(2 * len(pairs), dtype=contact_dtype)
+
+        if self.backend == 'numba':
+            nrows = _residue_minima_rows(pairs, dists, self.rinds1,
+                                         self.rinds2, len(self.ures2),
+                                         self.ures1, self.ures2,
+                                         self._rows['presid'],
+                                         self._rows['lresid'],
+                                         self._rows['distance'])
+            return self._rows[:nrows]
+
+        r1, r2, mind = residue_minima(pairs, dists, self.rinds1, self.rinds2,
+                                      len(self.ures2))
+        rows = self._rows[:len(mind)]
+        rows['presid'] = self.ures1[r1]
+        rows['lresid'] = self.ures2[r2]
+        rows['distance'] = mind
+        return rows
+
+    def pair_distances(self, pos1, pos2, presid, lresid):
+        """
+        Minimum atomic distance of each of the given residue pairs, computed
+        from the atoms of these residues alone.
+
+        :param pos1: Positions of the first atom group
+        :type pos1: array
+        :param pos2: Positions of the second atom group
+        :type pos2: array
+        :param presid: Residue id in the first group of each pair
+        :type presid: array
+        :param lresid: Residue id in the second group of each pair
+        :type lresid: array
+        """
+        if len(presid) == 0:
+            return np.empty(0)
+        order1, starts1, counts1 = self.groups1
+        order2, starts2, counts2 = self.groups2
+        r1 = np.searchsorted(self.ures1, presid)
+        r2 = np.searchsorted(self.ures2, lresid)
+        # every atom of the first residue against every atom of the second
+        n2 = counts2[r2]
+        sizes = counts1[r1] * n2
+        offsets = np.cumsum(sizes) - sizes
+        pair = np.repeat(np.arange(len(sizes)), sizes)
+        k = np.arange(sizes.sum()) - offsets[pair]
+        atoms1 = starts1[r1][pair] + k // n2[pair]
+        atoms2 = starts2[r2][pair] + k % n2[pair]
+        if order1 is not None:
+            atoms1 = order1[atoms1]
+        if order2 is not None:
+            atoms2 = order2[atoms2]
+        dists = np.sqrt(((pos1[atoms1].astype(np.float64) -
+                          pos2[atoms2])**2).sum(axis=1))
+        return np.minimum.reduceat(dists, offsets)
+
+    def close(self):
+        """
+        Stop the threads used to search a frame.
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def _pair_keys(rows):
+    return ContactStats._keys(rows['presid'], rows['lresid'])
+
+
+def _split_keys(keys):
+    return keys >> 32, (keys & 0xffffffff).astype(np.uint32).view(np.int32)
+
+
+def _pair_rows(keys, dists):
+    """
+    Rows of :data:`contact_dtype` of the residue pairs `keys`, with their
+    presid, lresid and distance filled.
+    """
+    rows = np.empty(len(keys), dtype=contact_dtype)
+    rows['presid'], rows['lresid'] = _split_keys(keys)
+    rows['distance'] = dists
+    return rows
+
+
+def _lookup(rows, keys):
+    """
+    Distances of the residue pairs `keys` among `rows`.
+    """
+    rowkeys = _pair_keys(rows)
+    order = np.argsort(rowkeys)
+    return rows['distance'][order[np.searchsorted(rowkeys[order], keys)]]
+
+
+class Refinement(object):
+    """
+    Contacts of every frame, found by searching only every `k`th frame and
+    refining in between. Residue pairs in contact at two consecutive samples
+    are taken to be in contact in all frames in between. For the pairs in
+    contact at only one of them, the frame at which the contact forms or
+    breaks is found by bisection, computing the distances of these pairs
+    alone. The first frame of each replica and the frame before are always
+    sampled.
+
+    Events lasting less than `k` frames that fall between two samples, and
+    breaks this short, are missed unless `transients` is given. The samples
+    are then searched at ``cutoff + transients`` and every pair found at
+    either of two samples is evaluated at each frame in between, which finds
+    all contacts of pairs moving less than `transients` over `k` frames while
+    still skipping the full search of these frames.
+
+    Frames that are not evaluated get the distance of the closest evaluated
+    frame of the same stretch of contact, and a time interpolated between
+    the samples.
+
+    Iterating yields the frame, time and rows of :data:`contact_dtype` of each
+    search of every frame, and the time spent reading frames is accumulated
+    in :attr:`wait`, as with :class:`Prefetcher`.
+
+    :param frames: Frames to analyze, in order
+    :type frames: array
+    :param searches: Searches of each second atom group, at the contact
+                     cutoff plus `transients`
+    :type searches: list of :class:`ContactSearch`
+    :param cutoffs: Contact cutoff of each search
+    :type cutoffs: list
+    :param k: Number of frames between samples
+    :type k: int
+    :param transients: Distance beyond the cutoff within which pairs are
+                       evaluated at every frame between samples, None to
+                       miss events shorter than `k` frames
+    :type transients: float, optional
+    :param replica_starts: First frame of each replica
+    :type replica_starts: list, optional
+    :param read: Reader of the frames, see :func:`_read_frames`
+    :type read: callable
+    """
+
+    def __init__(self, frames, searches, cutoffs, k, transients=None,
+                 replica_starts=None, read=_read_frames):
+        self.frames = np.asarray(frames)
+        self.searches, self.cutoffs = searches, cutoffs
+        self.k, self.transients = k, transients
+        self.replica_starts = replica_starts or []
+        self.read = read
+        self.wait = 0.0
+
+    def _read(self, positions):
+        reader = iter(self.read(self.frames[positions]))
+        while True:
+            start = timer.perf_counter()
+            item = next(reader, None)
+            self.wait += timer.perf_counter() - start
+            if item is None:
+                return
+            yield item
+
+    def _samples(self):
+        n = len(self.frames)
+        samples = set(range(0, n, self.k)) | {n - 1}
+        for start in self.replica_starts:
+            i = np.searchsorted(self.frames, start)
+            if 0 < i < n:
+                samples |= {i - 1, i}
+        return sorted(samples)
+
+    def __iter__(self):
+        previous = None
+        for i in self._samples():
+            frame, time, pos1, pos2s = next(self._read([i]))
+            rows = [search.rows(pos1, pos2).copy() for search, pos2 in
+                    zip(self.searches, pos2s)]
+            current = (i, time, rows)
+            if previous is not None and i > previous[0] + 1:
+                if self.transients is None:
+                    yield from self._fill(previous, current)
+                else:
+                    yield from self._scan(previous, current)
+            yield frame, time, [r[r['distance'] <= cutoff] for r, cutoff in
+                                zip(rows, self.cutoffs)]
+            previous = current
+
+    def _scan(self, previous, current):
+        """
+        Evaluate the pairs found at either sample in every frame in between.
+        """
+        (a, _, before), (b, _, after) = previous, current
+        keys = [np.union1d(_pair_keys(x), _pair_keys(y)) for x, y in
+                zip(before, after)]
+        for frame, time, pos1, pos2s in self._read(np.arange(a + 1, b)):
+            contacts = []
+            for search, cutoff, pairs, pos2 in zip(self.searches,
+                                                   self.cutoffs, keys, pos2s):
+                dists = search.pair_distances(pos1, pos2,
+                                              *_split_keys(pairs))
+                near = dists <= cutoff
+                contacts.append(_pair_rows(pairs[near], dists[near]))
+            yield frame, time, contacts
+
+    def _fill(self, previous, current):
+        """
+        Fill the frames between two samples from the stretches of contact of
+        each pair, bisecting those that start or end in between.
+        """
+        (a, ta, before), (b, tb, after) = previous, current
+        stretches, changes = [], []
+        for x, y in zip(before, after):
+            kx, ky = _pair_keys(x), _pair_keys(y)
+            both = np.intersect1d(kx, ky)
+            changed = np.setxor1d(kx, ky)
+            inlo = np.isin(changed, kx)
+            # distance at the sample in contact
+            dsample = np.empty(len(changed))
+            dsample[inlo] = _lookup(x, changed[inlo])
+            dsample[~inlo] = _lookup(y, changed[~inlo])
+            stretches.append((both, _lookup(x, both), _lookup(y, both),
+                              dsample))
+            changes.append([changed, inlo, np.full(len(changed), a),
+                            np.full(len(changed), b), dsample.copy(),
+                            dsample.copy()])
+
+        # bisect all pairs of all searches, reading each midpoint once
+        while True:
+            mids = [(lo + hi) // 2 for _, _, lo, hi, _, _ in changes]
+            active = [hi - lo > 1 for _, _, lo, hi, _, _ in changes]
+            positions = np.unique(np.concatenate(
+                [mid[act] for mid, act in zip(mids, active)] + [[]]).astype(
+                    int))
+            if len(positions) == 0:
+                break
+            for i, (_, _, pos1, pos2s) in zip(positions,
+                                              self._read(positions)):
+                for search, cutoff, pos2, change, mid, act in zip(
+                        self.searches, self.cutoffs, pos2s, changes, mids,
+                        active):
+                    changed, inlo, lo, hi, dlo, dhi = change
+                    sel = np.flatnonzero(act & (mid == i))
+                    dists = search.pair_distances(
+                        pos1, pos2, *_split_keys(changed[sel]))
+                    same = (dists <= cutoff) == inlo[sel]
+                    lo[sel[same]], dlo[sel[same]] = i, dists[same]
+                    hi[sel[~same]], dhi[sel[~same]] = i, dists[~same]
+
+        # first and last position of each stretch with their distances
+        spans = []
+        for (both, dx, dy, dsample), (changed, inlo, lo, hi, dlo, dhi) in zip(
+                stretches, changes):
+            keys = np.concatenate([both, changed])
+            first = np.concatenate([np.full(len(both), a),
+                                    np.where(inlo, a, hi)])
+            last = np.concatenate([np.full(len(both), b),
+                                   np.where(inlo, lo, b)])
+            dfirst = np.concatenate([dx, np.where(inlo, dsample, dhi)])
+            dlast = np.concatenate([dy, np.where(inlo, dlo, dsample)])
+            order = np.argsort(keys)
+            spans.append((keys[order], first[order], last[order],
+                          dfirst[order], dlast[order]))
+
+        fa, fb = self.frames[a], self.frames[b]
+        for i in range(a + 1, b):
+            frame = self.frames[i]
+            contacts = []
+            for keys, first, last, dfirst, dlast in spans:
+                now = (first <= i) & (i <= last)
+                dists = np.where(i - first <= last - i, dfirst, dlast)
+                contacts.append(_pair_rows(keys[now], dists[now]))
+            yield frame, ta + (tb - ta) * (frame - fa) / (fb - fa), contacts
+
+
+class ChunkScheduler(object):
+    """
+    Hand out chunks of consecutive frames on demand. Chunks are sized from
+    the measured throughput to take about `target` seconds each, and shrink
+    towards the end of the run so that workers finish at about the same time
+    even when later frames are more expensive than earlier ones.
+
+    :param gaps: (start, stop) ranges of frame positions still to analyze
+    :type gaps: list
+    :param nproc: Number of processes the chunks are distributed over
+    :type nproc: int
+    :param target: Approximate time (s) to spend on a single chunk
+    :type target: float
+    :param max_size: Largest number of frames in a chunk
+    :type max_size: int
+    :param first_size: Number of frames of the chunks handed out before the
+                       throughput is known
+    :type first_size: int
+    """
+
+    def __init__(self, gaps, nproc, target=10.0, max_size=None,
+                 first_size=4):
+        self.gaps = [list(gap) for gap in gaps if gap[1] > gap[0]]
+        self.remaining = sum(stop - start for start, stop in self.gaps)
+        self.nproc, self.target = nproc, target
+        self.max_size = max_size or self.remaining
+        self.first_size = first_size
+        self.nframes, self.seconds = 0, 0.0
+
+    def record(self, nframes, seconds):
+        """
+        Record that a chunk of `nframes` frames took `seconds` to analyze.
+        """
+        self.nframes += nframes
+        self.seconds += seconds
+
+    def size(self):
+        """
+        Number of frames in the next chunk.
+        """
+        if self.nframes and self.seconds > 0:
+            size = self.nframes / self.seconds * self.target
+        else:
+            size = self.first_size
+        guided = -(-self.remaining // (2 * self.nproc))
+        return max(1, int(min(size, self.max_size, guided)))
+
+    def next(self):
+        """
+        (start, stop) positions of the frames of the next chunk, None once all
+        frames have been handed out.
+        """
+        if not self.gaps:
+            return None
+        gap = self.gaps[0]
+        start = gap[0]
+        stop = min(start + self.size(), gap[1])
+        gap[0] = stop
+        if gap[0] == gap[1]:
+            self.gaps.pop(0)
+        self.remaining -= stop - start
+        return start, stop
 
 
 class MapContacts(object):
@@ -20,56 +1783,435 @@ class MapContacts(object):
     atoms. A single cutoff is used to define a contact between the two groups,
     where if any atomic distance between the two groups is less than the cutoff,
     a contact is considered formed.
+
+    Several second atom groups, e.g. different lipid species, can be mapped
+    against the first in a single pass over the trajectory by passing lists
+    for `ag2`, and optionally `cutoff` and `map_name`. A separate contact map
+    is written for each of them.
+
+    :param u: Universe containing the topology and trajectory
+    :type u: :class:`MDAnalysis.Universe`
+    :param ag1: First atom group, usually the protein
+    :type ag1: :class:`MDAnalysis.AtomGroup`
+    :param ag2: Second atom group, usually the lipids, or a list of them
+    :type ag2: :class:`MDAnalysis.AtomGroup` or list
+    :param nproc: Number of processes to use
+    :type nproc: int
+    :param frames: Frames of the trajectory to analyze, all frames if None
+    :type frames: array, optional
+    :param cutoff: Maximum distance recorded in the contact map, or a list
+                   with the cutoff of each of the second atom groups
+    :type cutoff: float or list
+    :param nslices: Minimum number of chunks the frames are split into. Chunks
+                    are handed to the processes on demand and sized from the
+                    measured throughput, see :class:`ChunkScheduler`
+    :type nslices: int
+    :param prefilter: Only compute atomic distances for residues whose
+                      bounding spheres are within the cutoff, see
+                      :class:`ContactSearch`
+    :type prefilter: bool
+    :param skin: Reuse a neighbor list with this skin distance over
+                 consecutive frames, see :class:`ContactSearch`
+    :type skin: float, optional
+    :param resume: Reuse chunks completed by an interrupted run with the same
+                   inputs, only computing the missing frames
+    :type resume: bool
+    :param append: Only analyze the frames after the last frame of an existing
+                   map, e.g. of an extended trajectory, and append them to it
+    :type append: bool
+    :param map_name: Filename of the contact map, or a list with the filename
+                     of the map of each of the second atom groups. With several
+                     second atom groups and a single name, the maps are named
+                     e.g. contacts.0.npy, contacts.1.npy
+    :type map_name: str or list
+    :param nthreads: Number of threads searching each frame in every process,
+                     see :class:`ContactSearch`
+    :type nthreads: int
+    :param positions: Position store created by :func:`extract_positions` for
+                      the same atom groups, read instead of the trajectory.
+                      With several second atom groups, the store is created
+                      from their sum.
+    :type positions: str, optional
+    :param prefetch: Number of frames read ahead in a background thread while
+                     contacts are computed, 0 to read frames in turn
+    :type prefetch: int
+    :param backend: Backend reducing atom pairs to residue pairs, see
+                    :class:`ContactSearch`
+    :type backend: str
+    :param scratch: Directory for the intermediate files, e.g. on node-local
+                    storage, the directory of each map by default. Each map
+                    gets its own subdirectory, see :func:`scratch_dir`, which
+                    is removed once the map is written, or if the run fails
+                    and is not resumable
+    :type scratch: str, optional
+    :param refine: Only search every `refine`th frame and find the contacts
+                   of the frames in between by refining, see
+                   :class:`Refinement`. Contacts only form and break at the
+                   cutoff of the map between samples, so the map can only be
+                   processed at that cutoff
+    :type refine: int, optional
+    :param transients: With `refine`, distance beyond the cutoff within which
+                       residue pairs are evaluated at every frame, or None to
+                       miss events shorter than `refine` frames, see
+                       :class:`Refinement`
+    :type transients: float, optional
+    :param levels: Also build coarsened levels of each map with every
+                   `levels`th frame, e.g. [10, 100], see :func:`build_levels`
+    :type levels: list, optional
     """
 
     def __init__(self, u, ag1, ag2, nproc=1, frames=None, cutoff=10.0,
-                 nslices=100):
+                 nslices=100, prefilter=True, skin=None, resume=True,
+                 append=False, map_name='contacts.npy', nthreads=1,
+                 positions=None, prefetch=2, backend='auto', scratch=None,
+                 refine=None, transients=None, levels=None):
         self.u, self.nproc = u, nproc
         self.ag1, self.ag2 = ag1, ag2
         self.cutoff, self.frames, self.nslices = cutoff, frames, nslices
+        self.prefilter, self.skin = prefilter, skin
+        self.resume, self.append = resume, append
+        self.map_name, self.nthreads = map_name, nthreads
+        self.positions, self.prefetch = positions, prefetch
+        self.backend, self.scratch = backend, scratch
+        self.refine, self.transients = refine, transients
+        self.levels = levels
+
+        # one (ag2, cutoff, map_name) per lipid species mapped in the pass
+        ag2s = list(ag2) if isinstance(ag2, (list, tuple)) else [ag2]
+        cutoffs = (list(cutoff) if isinstance(cutoff, (list, tuple)) else
+                   [cutoff] * len(ag2s))
+        map_names = (list(map_name) if isinstance(map_name, (list, tuple))
+                     else _species_names(map_name, range(len(ag2s))))
+        if not len(ag2s) == len(cutoffs) == len(map_names):
+            raise ValueError('ag2, cutoff and map_name must have the same '
+                             'length')
+        self._species = list(zip(ag2s, cutoffs, map_names))
 
     def run(self):
-        if self.frames is not None:
-            sliced_frames = np.array_split(self.frames, self.nslices)
+        if self.u.filename is None or self.u.trajectory.filename is None:
+            raise ValueError('MapContacts requires a Universe loaded from a '
+                             'topology and trajectory file')
+
+        metadatas = [{'top': _abspath(self.u.filename),
+                      'traj': _abspath(_trajectory_files(self.u)),
+                      'ag1_indices': self.ag1.indices.tolist(),
+                      'ag2_indices': ag2.indices.tolist(),
+                      'ts': float(self.u.trajectory.dt/1000),
+                      'cutoff': float(cutoff),
+                      'replica_starts': replica_starts(self.u),
+                      'refine': self.refine, 'transients': self.transients}
+                     for ag2, cutoff, _ in self._species]
+
+        if self.positions is not None:
+            self._check_positions(metadatas)
+
+        frames = (np.arange(len(self.u.trajectory)) if self.frames is None
+                  else np.asarray(self.frames))
+        if self.append:
+            previous = self._check_append(metadatas)
+            frames = frames[frames > previous['last_frame']]
+            if len(frames) == 0:
+                print('No new frames to add to '
+                      f'"{", ".join(m for _, _, m in self._species)}"')
+                return
+
+        scratch = [scratch_dir(map_name, self.scratch)
+                   for _, _, map_name in self._species]
+        for directory in scratch:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            self._map(frames, metadatas, previous if self.append else None)
+        except BaseException:
+            # completed chunks are kept for a resumed run
+            if not self.resume:
+                for directory in scratch:
+                    shutil.rmtree(directory, ignore_errors=True)
+            raise
+        for directory in scratch:
+            shutil.rmtree(directory)
+        if self.levels:
+            for _, _, map_name in self._species:
+                build_levels(map_name, self.levels)
+
+    def _map(self, frames, metadatas, previous):
+        """
+        Map the contacts of `frames` in chunks stored in the scratch
+        directories and assemble them into the contact maps.
+        """
+        done = self._completed_chunks(frames)
+        gaps, start = [], 0
+        for chunk in done + [(len(frames), len(frames))]:
+            gaps.append((start, chunk[0]))
+            start = chunk[1]
+        scheduler = ChunkScheduler(gaps, self.nproc,
+                                   max_size=-(-len(frames) // self.nslices))
+        settings = {'prefixes': [self._slice_name(k=k) for k in
+                                 range(len(self._species))],
+                    'cutoffs': [cutoff for _, cutoff, _ in self._species],
+                    'prefilter': self.prefilter,
+                    'skin': self.skin, 'nthreads': self.nthreads,
+                    'ts': metadatas[0]['ts'], 'positions': self.positions,
+                    'replica_starts': metadatas[0]['replica_starts'],
+                    'prefetch': self.prefetch, 'backend': self.backend,
+                    'refine': self.refine, 'transients': self.transients}
+        initargs = (Lock(), self.u.filename, _trajectory_files(self.u),
+                    self.ag1.indices,
+                    [ag2.indices for ag2, _, _ in self._species], settings)
+
+        ndone = len(frames) - scheduler.remaining
+        if done:
+            print(f'Resuming from {ndone} of {len(frames)} frames in '
+                  'completed chunks')
+        timings = np.zeros(2)
+        with (Pool(self.nproc, initializer=_init_worker, initargs=initargs)
+              as p, tqdm(total=len(frames), initial=ndone, position=0,
+                         desc='overall progress') as pbar):
+            results, running = queue.Queue(), 0
+            while True:
+                # keep every process busy with a queued chunk in reserve
+                while running < 2 * self.nproc:
+                    chunk = scheduler.next()
+                    if chunk is None:
+                        break
+                    p.apply_async(self._run_contacts,
+                                  (chunk[0], frames[chunk[0]:chunk[1]]),
+                                  callback=results.put,
+                                  error_callback=results.put)
+                    done.append(chunk)
+                    running += 1
+                if running == 0:
+                    break
+                result = results.get()
+                running -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                nframes, wait, compute = result
+                scheduler.record(nframes, wait + compute)
+                timings += wait, compute
+                pbar.update(nframes)
+        if ndone < len(frames):
+            print(f'\nWaited {timings[0]:.1f} s for frames to be read and '
+                  f'spent {timings[1]:.1f} s computing contacts, summed over '
+                  'processes')
+
+        chunks = sorted(done)
+        for k, (metadata, (_, _, map_name)) in enumerate(
+                zip(metadatas, self._species)):
+            metadata['first_frame'] = (previous['first_frame'] if self.append
+                                       else int(frames.min()))
+            metadata['last_frame'] = int(frames.max())
+            self._assemble(k, chunks, metadata, previous)
+        os.remove(self._slice_name('json'))
+
+    def _assemble(self, k, chunks, metadata, previous):
+        """
+        Write the chunks of the `k`th second atom group to its contact map in
+        frame order, or append them to it, and remove the chunks.
+        """
+        map_name = self._species[k][2]
+        stats = self._stats(k, chunks, metadata, previous)
+        lens = np.array([os.path.getsize(self._slice_name(chunk, k)) //
+                         contact_dtype.itemsize for chunk in chunks])
+        slices = (np.memmap(self._slice_name(chunk, k), mode='r',
+                            dtype=contact_dtype, shape=(lens[i],))
+                  if lens[i] > 0 else np.empty(0, dtype=contact_dtype)
+                  for i, chunk in enumerate(chunks))
+
+        if self.append:
+            append_contacts(map_name, slices)
         else:
-            sliced_frames = np.array_split(np.arange(len(self.u.trajectory)),
-                                           self.nslices)
-
-        input_list = [[i, self.u.trajectory[aslice]] for
-                      i, aslice in enumerate(sliced_frames)]
-
-        lens = []
-        with (Pool(self.nproc, initializer=tqdm.set_lock, initargs=(Lock(),))
-              as p):
-            for alen in tqdm(p.istarmap(self._run_contacts, input_list),
-                          total=self.nslices, position=0,
-                          desc='overall progress'):
-                lens.append(alen)
-        lens = np.array(lens)
-        mapsize = sum(lens)
-        bounds = np.concatenate([[0], np.cumsum(lens)])
-        dtype = np.dtype(np.float64,
-                         metadata={'top': self.u.filename,
-                                   'traj': self.u.trajectory.filename,
-                                   'ag1': self.ag1, 'ag2': self.ag2,
-                                   'ts': self.u.trajectory.dt/1000,
-                                   'cutoff': self.cutoff})
-
-        contact_map = np.memmap('.tmpmap', mode='w+',
-                                shape=(mapsize, 5), dtype=dtype)
-        for i in range(self.nslices):
-            contact_map[bounds[i]:bounds[i+1]] = np.genfromtxt(f'.contacts_'
-                                                               f'{i:04}',
-                                                               delimiter=',')
+            bounds = np.concatenate([[0], np.cumsum(lens)])
+            contact_map = open_memmap(map_name, mode='w+',
+                                      shape=(int(sum(lens)),),
+                                      dtype=contact_dtype)
+            for i, aslice in enumerate(slices):
+                contact_map[bounds[i]:bounds[i+1]] = aslice
             contact_map.flush()
+            del contact_map
+        self._occupancy(k, chunks)
+        for chunk in chunks:
+            os.remove(self._slice_name(chunk, k))
+            os.remove(f'{self._slice_name(chunk, k)}.stats.npz')
+            os.remove(f'{self._slice_name(chunk, k)}.occupancy.npy')
+        save_metadata(map_name, metadata)
+        if stats is not None:
+            save_stats(map_name, stats.table(metadata['ts']), stats.nframes)
+        print(f'\nSaved contacts as "{map_name}"')
+
+    def _occupancy(self, k, chunks):
+        """
+        Write the occupancy of the chunks of the `k`th second atom group next
+        to its contact map, or append it to the existing occupancy. Maps
+        without an occupancy are not given a partial one when appending.
+        """
+        name = _occupancy_name(self._species[k][2])
+        occupancy = [np.load(f'{self._slice_name(chunk, k)}.occupancy.npy',
+                             mmap_mode='r') for chunk in chunks]
+        if self.append:
+            if os.path.exists(name):
+                append_contacts(name, occupancy)
+            return
+        _write_rows(name, occupancy, sum(len(occ) for occ in occupancy),
+                    occupancy_dtype(len(np.unique(self.ag1.resids))))
+        save_metadata(name, {'resids': np.unique(self.ag1.resids).tolist()})
+
+    def _stats(self, k, chunks, metadata, previous):
+        """
+        Combine the statistics of the chunks of the `k`th second atom group,
+        continuing those of the existing map when appending. None if the
+        existing map has no statistics to continue.
+        """
+        resids = np.unique(self.ag1.resids)
+        starts = metadata['replica_starts']
+        stats = ContactStats(resids, starts)
+        if previous is not None:
+            map_name = self._species[k][2]
+            if not os.path.exists(_stats_name(map_name)):
+                return None
+            # the rows of the last frame mapped so far end the map
+            frames = np.load(map_name, mmap_mode='r')['frame']
+            last = np.load(map_name, mmap_mode='r')[
+                bisect.bisect_left(frames, previous['last_frame']):]
+            stats = ContactStats.from_table(
+                load_stats(map_name), metadata['ts'],
+                last=(previous['last_frame'], last['presid'], last['lresid']),
+                replica_starts=starts)
+        for chunk in chunks:
+            stats.update(ContactStats.load(
+                f'{self._slice_name(chunk, k)}.stats.npz', resids, starts))
+        return stats
+
+    def _slice_name(self, chunk=None, k=0):
+        """
+        Name of the hidden per-chunk files of the map of the `k`th second atom
+        group, for the (start, stop) positions of the frames of a `chunk` or
+        'json' for the manifest of the chunks.
+        """
+        map_name = self._species[k][2]
+        prefix = os.path.join(scratch_dir(map_name, self.scratch),
+                              os.path.splitext(os.path.basename(map_name))[0])
+        if chunk is None:
+            return prefix
+        if chunk == 'json':
+            return f'{prefix}.json'
+        return f'{prefix}_{chunk[0]:09}_{chunk[1]:09}'
 
-        contact_map.dump('contacts.pkl', protocol=5)
-        os.remove('.tmpmap')
-        cfiles = glob.glob('.contacts*')
-        [os.remove(f) for f in cfiles]
-        print('\nSaved contacts as "contacts.pkl"')
+    @staticmethod
+    def _chunk_files(prefix):
+        """
+        Committed and partial chunk files with the given prefix and their
+        statistics and occupancy, along with their (start, stop) and whether
+        they are a committed chunk.
+        """
+        directory = os.path.dirname(prefix) or '.'
+        if not os.path.isdir(directory):
+            return []
+        pattern = re.compile(rf'{re.escape(os.path.basename(prefix))}'
+                             r'_(\d{9})_(\d{9})'
+                             r'(\.part|\.stats\.npz|\.occupancy\.npy)?$')
+        files = []
+        for name in os.listdir(directory):
+            match = pattern.match(name)
+            if match:
+                chunk = (int(match.group(1)), int(match.group(2)))
+                files.append((os.path.join(os.path.dirname(prefix), name),
+                              chunk, match.group(3) is None))
+        return files
 
-    def _run_contacts(self, i, sliced_traj):
+    def _check_append(self, metadatas):
+        """
+        Make sure the existing contact maps were created from the same
+        topology, selections, cutoffs and refinement and cover the same
+        frames, and return the metadata of the first.
+        """
+        previous = []
+        for metadata, (_, _, map_name) in zip(metadatas, self._species):
+            if not os.path.exists(map_name):
+                raise FileNotFoundError(f'{map_name} not found, nothing to '
+                                        'append to')
+            if np.load(map_name, mmap_mode='r').dtype != contact_dtype:
+                raise ValueError(f'Cannot append to {map_name}, its rows do '
+                                 'not have the current contact format')
+            meta = load_metadata(map_name)
+            for key in ['top', 'ag1_indices', 'ag2_indices', 'ts', 'cutoff',
+                        'refine', 'transients']:
+                # maps from before refinement have no refine or transients
+                if meta.get(key) != metadata[key]:
+                    raise ValueError(f'Cannot append to {map_name}, "{key}" '
+                                     'differs from the existing contact map')
+            if 'last_frame' not in meta:
+                frames = np.load(map_name, mmap_mode='r')['frame']
+                meta['first_frame'] = int(frames.min(initial=0))
+                meta['last_frame'] = int(frames.max(initial=-1))
+            if previous and meta['last_frame'] != previous[0]['last_frame']:
+                raise ValueError(f'Cannot append to {map_name}, it ends at a '
+                                 'different frame than '
+                                 f'{self._species[0][2]}')
+            previous.append(meta)
+        return previous[0]
+
+    def _check_positions(self, metadatas):
+        """
+        Make sure the position store was extracted from the same trajectory
+        and atom groups as these maps, the second atom groups being stored one
+        after the other.
+        """
+        store = load_positions(self.positions)
+        metadata = dict(metadatas[0], ag2_indices=sum(
+            (meta['ag2_indices'] for meta in metadatas), []))
+        for key in ['top', 'traj', 'ag1_indices', 'ag2_indices']:
+            if store.dtype.metadata[key] != metadata[key]:
+                raise ValueError(f'Cannot use {self.positions}, "{key}" '
+                                 'differs from the contact map')
+        if len(store) != len(self.u.trajectory):
+            raise ValueError(f'{self.positions} has {len(store)} frames, the '
+                             f'trajectory has {len(self.u.trajectory)}')
+
+    def _completed_chunks(self, frames):
+        """
+        (start, stop) of the chunks already committed by a previous run with
+        the same trajectory, selections, settings and frames, in frame order.
+        Chunk files of a run with different inputs, partial chunk files, or
+        all chunk files if not resuming, are removed.
+        """
+        key = hashlib.sha1()
+        key.update(json.dumps([_abspath(self.u.filename),
+                               _abspath(_trajectory_files(self.u)),
+                               [float(c) for _, c, _ in self._species],
+                               self.prefilter, self.skin, self.refine,
+                               self.transients]).encode())
+        for arr in [self.ag1.indices, *[ag2.indices for ag2, _, _ in
+                                        self._species], frames]:
+            key.update(np.ascontiguousarray(arr, dtype=np.int64).tobytes())
+        prefixes = [self._slice_name(k=k) for k in range(len(self._species))]
+        manifest = {'key': key.hexdigest(), 'prefixes': prefixes}
+
+        previous = None
+        if os.path.exists(self._slice_name('json')):
+            with open(self._slice_name('json'), 'r') as f:
+                previous = json.load(f)
+        keep = self.resume and previous == manifest
+        if previous is not None and not keep:
+            print('Removing chunks of a previous run')
+
+        # a chunk is complete once it is committed for every map
+        files = [self._chunk_files(prefix) for prefix in
+                 (prefixes if keep or previous is None else
+                  previous.get('prefixes', prefixes[:1]))]
+        chunks = [set(chunk for _, chunk, committed in species if committed)
+                  for species in files]
+        done = sorted(set.intersection(*chunks)) if keep else []
+        for species in files:
+            for name, chunk, _ in species:
+                if chunk not in done or name.endswith('.part'):
+                    os.remove(name)
+
+        with open(self._slice_name('json'), 'w') as f:
+            json.dump(manifest, f)
+        return done
+
+    @staticmethod
+    def _run_contacts(start, frames):
         from basicrta.util import get_dec
 
         try:
@@ -77,135 +2219,414 @@ class MapContacts(object):
         except ValueError:
             proc = 1
 
-        with open(f'.contacts_{i:04}', 'w+') as f:
-            dec = get_dec(self.u.trajectory.ts.dt/1000)  # convert to ns
-            text = f'slice {i+1} of {self.nslices}'
-            data_len = 0
-            for ts in tqdm(sliced_traj, desc=text, position=proc,
-                           total=len(sliced_traj), leave=False):
-                dset = []
-                b = distances.capped_distance(self.ag1.positions,
-                                              self.ag2.positions,
-                                              max_cutoff=self.cutoff)
-                pairlist = [(self.ag1.resids[b[0][i, 0]],
-                             self.ag2.resids[b[0][i, 1]]) for i in
-                            range(len(b[0]))]
-                pairdir = collections.Counter(a for a in pairlist)
-                lsum = 0
-                for j in pairdir:
-                    temp = pairdir[j]
-                    dset.append([ts.frame, j[0], j[1],
-                                 min(b[1][lsum:lsum+temp]),
-                                 np.round(ts.time, dec)/1000])  # convert to ns
-                    lsum += temp
-                [f.write(f"{line}".strip('[]') + "\n") for line in dset]
-                data_len += len(dset)
-            f.flush()
-        return data_len
+        ag1, ag2 = _worker['ag1'], _worker['ag2']
+        refine, transients = _worker['refine'], _worker['transients']
+        # refined samples also find the pairs that may come into contact
+        margin = transients if refine and transients else 0
+        searches = [ContactSearch(ag1.resids, ag.resids, cutoff + margin,
+                                  prefilter=_worker['prefilter'],
+                                  skin=_worker['skin'],
+                                  nthreads=_worker['nthreads'],
+                                  backend=_worker['backend'])
+                    for ag, cutoff in zip(ag2, _worker['cutoffs'])]
+        # the chunk is only committed under its final name once complete
+        names = [f'{prefix}_{start:09}_{start + len(frames):09}'
+                 for prefix in _worker['prefixes']]
+        with ExitStack() as stack:
+            files = [stack.enter_context(open(f'{name}.part', 'wb'))
+                     for name in names]
+            dec = get_dec(_worker['ts'])
+            text = f'frames {frames[0]}-{frames[-1]}'
+            starts = _worker['replica_starts']
+            stats = [ContactStats(search.ures1, starts) for search in
+                     searches]
+            occupancy = [np.zeros(len(frames),
+                                  dtype=occupancy_dtype(len(search.ures1)))
+                         for search in searches]
+            if refine:
+                reader = Refinement(frames, searches, _worker['cutoffs'],
+                                    refine, transients, starts)
+                contacts = iter(reader)
+            else:
+                reader = Prefetcher(_read_frames(frames), _worker['prefetch'])
+                contacts = ((frame, time, [search.rows(pos1, pos2) for
+                                           search, pos2 in zip(searches,
+                                                               pos2s)])
+                            for frame, time, pos1, pos2s in reader)
+            tick = timer.perf_counter()
+            for j, (frame, time, rows) in enumerate(tqdm(
+                    contacts, desc=text, position=proc, total=len(frames),
+                    leave=False)):
+                for search, dset, f, stat, occ in zip(searches, rows, files,
+                                                      stats, occupancy):
+                    dset['frame'] = frame
+                    dset['time'] = np.round(time, dec)/1000  # convert to ns
+                    dset['replica'] = np.searchsorted(starts, frame,
+                                                      side='right') - 1
+                    dset.tofile(f)
+                    stat.add(frame, dset['presid'], dset['lresid'])
+                    # every row is a different lipid of the residue
+                    occ['frame'][j] = frame
+                    occ['nlipids'][j] = np.minimum(np.bincount(
+                        np.searchsorted(search.ures1, dset['presid']),
+                        minlength=len(search.ures1)), np.iinfo(np.uint16).max)
+            compute = timer.perf_counter() - tick - reader.wait
+            for f in files:
+                f.flush()
+                os.fsync(f.fileno())
+        for search in searches:
+            search.close()
+        for name, stat, occ in zip(names, stats, occupancy):
+            stat.save(f'{name}.stats.npz')
+            np.save(f'{name}.occupancy.npy', occ)
+            os.replace(f'{name}.part', name)
+        return len(frames), reader.wait, compute
+
+
+def _residence_events(rows, stride=1):
+    """
+    Residence events of the residue pairs in contact in `rows` of
+    :data:`contact_dtype`, sorted by protein residue, lipid and frame. The
+    rows of a coarsened level are `stride` frames apart.
+    """
+    rows = rows[np.lexsort((rows['frame'], rows['lresid'], rows['presid']))]
+    # a residence event starts wherever the residue pair changes or a frame
+    # is skipped
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = ((rows['presid'][1:] != rows['presid'][:-1]) |
+                  (rows['lresid'][1:] != rows['lresid'][:-1]) |
+                  (np.diff(rows['frame']) != stride))
+    if 'replica' in rows.dtype.names:
+        # nor does an event continue from one replica into the next
+        starts[1:] |= rows['replica'][1:] != rows['replica'][:-1]
+    starts = np.flatnonzero(starts)
+
+    dset = np.empty(len(starts), dtype=event_dtype)
+    dset['presid'] = rows['presid'][starts]
+    dset['lresid'] = rows['lresid'][starts]
+    dset['frame'] = rows['frame'][starts]
+    dset['time'] = rows['time'][starts]
+    dset['nframes'] = np.diff(np.append(starts, len(rows)))
+    dset['replica'] = (rows['replica'][starts] if 'replica' in
+                       rows.dtype.names else 0)
+    return dset
 
 
 class ProcessContacts(object):
-    def __init__(self, cutoff, nproc, map_name='contacts.pkl'):
+    def __init__(self, cutoff, nproc, map_name='contacts.npy', scratch=None,
+                 levels=None):
         self.nproc = nproc
         self.map_name = map_name
         self.cutoff = cutoff
+        self.scratch = scratch
+        # also process these coarsened levels of the map, see build_levels
+        self.levels = levels
 
     def run(self):
-        from basicrta.util import siground
-
         if os.path.exists(self.map_name):
-            with open(self.map_name, 'r+b') as f:
-                memmap = pickle.load(f)
-            # memmap = np.load(self.map_name, mmap_mode='r')
-            dtype = memmap.dtype
-            memmap = memmap[memmap[:, -2] <= self.cutoff]
+            metadata = load_contacts(self.map_name).dtype.metadata
+        elif os.path.exists(_compressed_name(self.map_name)):
+            metadata = load_metadata(self.map_name)
         else:
             raise FileNotFoundError(f'{self.map_name} not found. Specify the '
                                     'contacts file using the "map_name" '
                                     'argument')
 
-        self.ts = dtype.metadata['ts']
-        lresids = np.unique(memmap[:, 2])
-        params = [[res, memmap[memmap[:, 2] == res], i] for i, res in
-                  enumerate(lresids)]
-        pool = Pool(self.nproc, initializer=tqdm.set_lock, initargs=(Lock(),))
+        if self.cutoff > metadata['cutoff']:
+            raise ValueError(f'{self.map_name} only contains contacts within '
+                             f'{metadata["cutoff"]}, not {self.cutoff}')
+        if metadata.get('refine') and self.cutoff != metadata['cutoff']:
+            # contacts only form and break at the cutoff between samples
+            raise ValueError(f'{self.map_name} was mapped with refine, and '
+                             'can only be processed at its own cutoff '
+                             f'{metadata["cutoff"]}, not {self.cutoff}')
+        self.ts = metadata['ts']
+        self.stride = metadata.get('stride', 1)
+        map_name = f'{os.path.splitext(self.map_name)[0]}_{self.cutoff}.npy'
+        if self._bits_current(metadata):
+            words, times, _ = load_bits(_bits_name(self.map_name,
+                                                   self.cutoff))
+            np.save(map_name, bit_events(words, times,
+                                         metadata['first_frame'],
+                                         metadata.get('replica_starts'),
+                                         self.stride))
+            frames = bit_frames(words)
+        elif _compressed_current(self.map_name):
+            frames = self._residue_events(map_name)
+        else:
+            frames = self._row_events(map_name)
+        stats = self._stats(frames, np.load(map_name, mmap_mode='r'),
+                            metadata)
+        save_metadata(map_name, metadata)
+        save_stats(map_name, stats.table(self.ts), stats.nframes)
+        print(f'\nSaved contacts to "{map_name}"')
 
-        try:
-            lens = pool.starmap(self._lipswap, params)
-        except KeyboardInterrupt:
-            pool.terminate()
-        pool.close()
-
-        bounds = np.concatenate([[0], np.cumsum(lens)]).astype(int)
-        mapsize = sum(lens)
-        contact_map = np.memmap(f'.tmpmap', mode='w+',
-                                shape=(mapsize, 4), dtype=dtype)
-
-        for i in range(len(lresids)):
-            contact_map[bounds[i]:bounds[i+1]] = np.load(f'.contacts_{i:04}.'
-                                                         f'npy')
-            contact_map.flush()
+        for stride in self.levels or []:
+            level = _level_name(self.map_name, stride)
+            # a map removed after compression cannot rebuild its levels
+            if os.path.exists(self.map_name) and (
+                    not os.path.exists(level) or os.path.getmtime(level) <
+                    os.path.getmtime(self.map_name)):
+                build_levels(self.map_name, [stride])
+            if not (os.path.exists(level) or
+                    os.path.exists(_compressed_name(level))):
+                print(f'Skipping {level}, {self.map_name} is needed to build '
+                      'it')
+                continue
+            ProcessContacts(self.cutoff, self.nproc, map_name=level,
+                            scratch=self.scratch).run()
 
-        contact_map.dump(f'contacts_{self.cutoff}.pkl', protocol=5)
-        # os.remove('.tmpmap')
-        # cfiles = glob.glob('.contacts*')
-        # [os.remove(f) for f in cfiles]
-        print(f'\nSaved contacts to "contacts_{self.cutoff}.npy"')
+    def _bits_current(self, metadata):
+        """
+        Whether the map has bit sets at this cutoff covering all its frames.
+        """
+        bits_name = _bits_name(self.map_name, self.cutoff)
+        if not os.path.exists(bits_name):
+            return False
+        bits_metadata = load_metadata(bits_name)
+        if any(bits_metadata.get(key) != metadata.get(key) for key in
+               ['first_frame', 'last_frame', 'traj']):
+            print(f'Ignoring {bits_name}, it does not cover the frames of '
+                  f'{self.map_name}')
+            return False
+        return True
 
+    def _residue_events(self, map_name):
+        """
+        Write the events of the compressed copy of the map to `map_name`,
+        reading the rows of one residue of the first group at a time, and
+        return the residues in contact with their number of frames in
+        contact.
+        """
+        self._store = _compressed_name(self.map_name)
+        self._mtime = os.path.getmtime(self._store)
+        presids = _open_compressed(self._store, self._mtime).resids
+        self._scratch = tempfile.mkdtemp(
+            prefix=f'{os.path.basename(scratch_dir(map_name))}.',
+            dir=self.scratch or os.path.dirname(os.path.abspath(map_name)))
+        try:
+            with Pool(self.nproc, initializer=tqdm.set_lock,
+                      initargs=(Lock(),)) as pool:
+                results = pool.starmap(self._resswap,
+                                       [[presid, i] for i, presid in
+                                        enumerate(presids)])
+            events = np.concatenate([np.empty(0, dtype=event_dtype)] +
+                                    [np.load(self._lipswap_name(i)) for i in
+                                     range(len(presids))])
+        finally:
+            shutil.rmtree(self._scratch, ignore_errors=True)
+        # in the order of the events found lipid by lipid
+        np.save(map_name, events[np.lexsort((events['frame'],
+                                             events['presid'],
+                                             events['lresid']))])
+        counts = np.array([nframes for _, nframes in results], dtype=int)
+        return presids[counts > 0], counts[counts > 0]
 
-    def _lipswap(self, lip, memarr, i):
-        from basicrta.util import get_dec
+    def _row_events(self, map_name):
+        """
+        Write the events of the rows of the map to `map_name`, and return the
+        residues in contact with their number of frames in contact.
+        """
+        memmap = load_contacts(self.map_name)
+        memmap = memmap[memmap['distance'] <= self.cutoff]
+        keys = np.unique(ContactStats._keys(memmap['presid'],
+                                            memmap['frame']))
+        frames = np.unique(keys >> 32, return_counts=True)
+
+        memmap = memmap[np.argsort(memmap['lresid'], kind='stable')]
+        lresids, splits = np.unique(memmap['lresid'], return_index=True)
+        params = [[res, memarr, i] for i, (res, memarr) in
+                  enumerate(zip(lresids, np.split(memmap, splits[1:])))]
+        # the per-lipid events of this run only, removed whatever happens
+        self._scratch = tempfile.mkdtemp(
+            prefix=f'{os.path.basename(scratch_dir(map_name))}.',
+            dir=self.scratch or os.path.dirname(os.path.abspath(map_name)))
         try:
-            # proc = int(multiprocessing.current_process().name[-1])
-            proc = int(multiprocessing.current_process().name.split('-')[-1])
-        except ValueError:
-            proc = 1
+            with Pool(self.nproc, initializer=tqdm.set_lock,
+                      initargs=(Lock(),)) as pool:
+                lens = pool.starmap(self._lipswap, params)
 
-        presids = np.unique(memarr[:, 1])
-        dset = []
-        dec, ts = get_dec(self.ts), self.ts
-        for pres in tqdm(presids, desc=f'lipID {int(lip)}', position=proc,
-                         leave=False):
-            stimes = np.round(memarr[:, -1][memarr[:, 1] == pres], dec)
-            if len(stimes) == 0:
-                continue
-            stimes = np.concatenate([np.array([-1]), stimes,
-                                     np.array([stimes[-1] + 1])])
-            diff = np.round(stimes[1:] - stimes[:-1], dec)
-            singles = stimes[
-                np.where((diff[1:] > ts) & (diff[:-1] > ts))[0] + 1]
-            diff[diff > ts] = 0
-            inds = np.where(diff == 0)[0]
-            sums = [sum(diff[inds[i]:inds[i + 1]]) for i in
-                    range(len(inds) - 1)]
-            clens = np.round(np.array(sums), dec)
-            minds = np.where(clens != 0)[0]
-            clens = clens[minds] + ts
-            strt_times = stimes[inds[minds] + 1]
-
-            [dset.append([pres, lip, time, ts]) for time in singles]
-            [dset.append([pres, lip, time, clen]) for time, clen in
-             zip(strt_times, clens)]
-        np.save(f'.contacts_{i:04}', np.array(dset))
+            bounds = np.concatenate([[0], np.cumsum(lens)]).astype(int)
+            mapsize = int(sum(lens))
+            contact_map = open_memmap(map_name, mode='w+', shape=(mapsize,),
+                                      dtype=event_dtype)
+
+            for i in range(len(lresids)):
+                if lens[i] > 0:
+                    contact_map[bounds[i]:bounds[i+1]] = np.load(
+                        self._lipswap_name(i))
+            contact_map.flush()
+            del contact_map
+        finally:
+            shutil.rmtree(self._scratch, ignore_errors=True)
+        return frames
+
+    def _lipswap(self, lip, memarr, i):
+        dset = _residence_events(memarr, self.stride)
+        np.save(self._lipswap_name(i), dset)
         return len(dset)
 
+    def _resswap(self, presid, i):
+        rows = _open_compressed(self._store, self._mtime).residue(presid)
+        rows = rows[rows['distance'] <= self.cutoff]
+        dset = _residence_events(rows, self.stride)
+        np.save(self._lipswap_name(i), dset)
+        return len(dset), len(np.unique(rows['frame']))
+
+    def _stats(self, frames, events, metadata):
+        """
+        Per-residue statistics of the events, covering the same residues and
+        frames as the statistics of the contact map if it has them. `frames`
+        are the residues in contact and their number of frames in contact.
+        """
+        presids, counts = frames
+        if os.path.exists(_stats_name(self.map_name)):
+            mapstats = load_stats(self.map_name)
+            resids = mapstats['presid']
+            nframes = mapstats.dtype.metadata['nframes']
+        else:
+            resids = presids
+            nframes = ((metadata['last_frame'] - metadata['first_frame']) //
+                       metadata.get('stride', 1) + 1)
+
+        stats = ContactStats(resids)
+        stats.nframes = nframes
+        eventinds = np.searchsorted(resids, events['presid'])
+        stats.counts[0] = np.bincount(eventinds, minlength=len(resids))
+        stats.counts[1][np.searchsorted(resids, presids)] = counts
+        stats.counts[2] = np.bincount(eventinds, weights=events['nframes'],
+                                      minlength=len(resids))
+        return stats
+
+    def _lipswap_name(self, i):
+        return os.path.join(self._scratch, f'contacts_{i:04}.npy')
+
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('--top', type=str)
-    parser.add_argument('--traj', type=str)
+    parser.add_argument('--traj', type=str, nargs='+',
+                        help='trajectory, or the trajectories of independent '
+                        'replicas')
     parser.add_argument('--sel1', type=str)
-    parser.add_argument('--sel2', type=str)
-    parser.add_argument('--cutoff', type=float)
+    parser.add_argument('--sel2', type=str, nargs='+',
+                        help='one or more selections mapped in a single pass')
+    parser.add_argument('--cutoff', type=float, nargs='+',
+                        help='cutoff of all selections or of each of them')
+    parser.add_argument('--map-cutoff', type=float, default=10.0,
+                        help='cutoff of the contact maps, at least every '
+                        '--cutoff so that the maps can be processed at other '
+                        'cutoffs later')
+    parser.add_argument('--names', type=str, nargs='+', default=None,
+                        help='names of the selections, used to name their '
+                        'contact maps (e.g. contacts.CHOL.npy)')
     parser.add_argument('--nproc', type=int, default=1)
     parser.add_argument('--nslices', type=int, default=100)
+    parser.add_argument('--no-prefilter', dest='prefilter',
+                        action='store_false')
+    parser.add_argument('--skin', type=float, default=None)
+    parser.add_argument('--nthreads', type=int, default=1)
+    parser.add_argument('--positions', type=str, default=None,
+                        help='position store to map from, extracted from the '
+                        'trajectory first if it does not exist')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='number of frames read ahead of the search')
+    parser.add_argument('--refine', type=int, default=None,
+                        help='only search every REFINE frames and refine the '
+                        'contacts in between, mapping at --cutoff instead of '
+                        '--map-cutoff')
+    parser.add_argument('--transients', type=float, default=None,
+                        help='with --refine, distance beyond the cutoff '
+                        'within which pairs are checked at every frame, '
+                        'events shorter than REFINE frames are missed '
+                        'otherwise')
+    parser.add_argument('--backend', type=str, default='auto',
+                        choices=['auto', 'numpy', 'numba'])
+    parser.add_argument('--scratch', type=str, default=None,
+                        help='directory for intermediate files, e.g. on '
+                        'node-local storage')
+    parser.add_argument('--bits', action='store_true',
+                        help='build bit sets of the maps at each --cutoff, '
+                        'from which residence events are found')
+    parser.add_argument('--levels', type=int, nargs='+', default=None,
+                        help='also build and process coarsened levels of the '
+                        'maps with every LEVELS frames, e.g. 10 100')
+    parser.add_argument('--compress', action='store_true',
+                        help='also store the maps and events compressed by '
+                        'residue')
+    parser.add_argument('--no-resume', dest='resume', action='store_false')
+    parser.add_argument('--append', action='store_true')
+    parser.add_argument('--start', type=int, default=None,
+                        help='first frame of the shard to map')
+    parser.add_argument('--stop', type=int, default=None,
+                        help='frame after the last frame of the shard to map')
+    parser.add_argument('--shard', type=int, default=None,
+                        help='index of the shard to map, out of --nshards')
+    parser.add_argument('--nshards', type=int, default=None)
+    parser.add_argument('--merge', type=str, nargs='+', default=None,
+                        help='shards to merge into contacts.npy, e.g. '
+                        'contacts.shard_0000.npy, or into the map of each of '
+                        '--names')
     args = parser.parse_args()
 
-    u = mda.Universe(args.top, args.traj)
-    cutoff, nproc, nslices = args.cutoff, args.nproc, args.nslices
-    ag1 = u.select_atoms(args.sel1)
-    ag2 = u.select_atoms(args.sel2)
+    nproc, nslices = args.nproc, args.nslices
+    # the selections are not needed to merge shards, only their names
+    nspecies = len(args.names) if args.names else len(args.sel2 or [None])
+    names = args.names or [str(k) for k in range(nspecies)]
+    cutoffs = args.cutoff * nspecies if len(args.cutoff) == 1 else \
+        args.cutoff
+    if len(cutoffs) != nspecies:
+        parser.error('--cutoff takes one cutoff or one per selection')
+    if not args.merge and not args.refine and max(cutoffs) > args.map_cutoff:
+        parser.error(f'--cutoff {max(cutoffs)} is larger than --map-cutoff '
+                     f'{args.map_cutoff}, contacts in between would be lost')
+    sharded = (args.shard is not None or args.start is not None or
+               args.stop is not None)
+    if args.merge:
+        # each shard named by --merge holds a map per selection
+        for k, map_name in enumerate(_species_names('contacts.npy', names)):
+            merge_shards([_species_names(shard, names)[k] for shard in
+                          args.merge], map_name=map_name)
+    else:
+        u = mda.Universe(args.top, args.traj)
+        ag1 = u.select_atoms(args.sel1)
+        ag2 = [u.select_atoms(sel) for sel in args.sel2]
+
+        frames, map_name = None, 'contacts.npy'
+        if args.shard is not None:
+            frames = np.array_split(np.arange(len(u.trajectory)),
+                                    args.nshards)[args.shard]
+            map_name = f'contacts.shard_{args.shard:04}.npy'
+        elif sharded:
+            frames = np.arange(len(u.trajectory))[args.start:args.stop]
+            map_name = f'contacts.shard_{frames[0]:09}.npy'
+
+        if args.positions and not os.path.exists(args.positions):
+            extract_positions(u, ag1, sum(ag2[1:], ag2[0]),
+                              store_name=args.positions)
+
+        MapContacts(u, ag1, ag2, nproc=nproc, frames=frames, nslices=nslices,
+                    # refined maps are only exact at their own cutoff
+                    cutoff=(cutoffs if args.refine else
+                            [args.map_cutoff] * nspecies),
+                    prefilter=args.prefilter, skin=args.skin,
+                    resume=args.resume, append=args.append,
+                    map_name=_species_names(map_name, names),
+                    nthreads=args.nthreads,
+                    positions=args.positions,
+                    prefetch=args.prefetch, backend=args.backend,
+                    scratch=args.scratch, refine=args.refine,
+                    transients=args.transients, levels=args.levels).run()
 
-    MapContacts(u, ag1, ag2, nproc=nproc, nslices=nslices).run()
-    ProcessContacts(cutoff, nproc).run()
+    if not sharded:
+        for cutoff, map_name in zip(cutoffs,
+                                    _species_names('contacts.npy', names)):
+            if args.bits:
+                build_bits(map_name, cutoff)
+            ProcessContacts(cutoff, nproc, map_name=map_name,
+                            scratch=args.scratch, levels=args.levels).run()
+            if args.compress:
+                compress_contacts(map_name)
+                compress_contacts(
+                    f'{os.path.splitext(map_name)[0]}_{cutoff}.npy')
@@ -129,34 +129,44 @@ class ParallelGibbs(object):
     """
 
     def __init__(self, contacts, nproc=1, ncomp=15, niter=110000):
-        self.cutoff = float(contacts.strip('.pkl').split('/')[-1].split('_')
-                            [-1])
+        self.cutoff = float(os.path.splitext(contacts)[0].split('/')[-1].
+                            split('_')[-1])
         self.niter = niter
         self.nproc = nproc
         self.ncomp = ncomp
         self.contacts = contacts
 
+    def _residence_times(self, contacts, resids):
+        """
+        Residence times (ns) of the events of each residue in `resids`. Event
+        lengths are whole numbers of frames, so the times need no rounding.
+        """
+        ts = contacts.metadata['ts']
+        return [contacts.residue(i)['nframes'] * ts for i in resids]
+
     def run(self, run_resids=None):
         from basicrta.util import run_residue
+        from basicrta.contacts import open_residues
 
-        with open(self.contacts, 'r+b') as f:
-            contacts = pickle.load(f)
+        # only the events of one residue at a time are read
+        contacts = open_residues(self.contacts)
 
-        protids = np.unique(contacts[:, 0])
+        protids = contacts.resids
         if not run_resids:
             run_resids = protids
 
         if not isinstance(run_resids, (list, np.ndarray)):
             run_resids = [run_resids]
 
-        rg = contacts.dtype.metadata['ag1'].residues
+        metadata = contacts.metadata
+        u = mda.Universe(metadata['top'])
+        rg = u.atoms[metadata['ag1_indices']].residues
         resids = rg.resids
         reslets = np.array([mda.lib.util.convert_aa_code(name) for name in
                             rg.resnames])
         residues = np.array([f'{reslet}{resid}' for reslet, resid in
                              zip(reslets, resids)])
-        times = [contacts[contacts[:, 0] == i][:, 3] for i in
-                 run_resids]
+        times = self._residence_times(contacts, run_resids)
         inds = np.array([np.where(resids == resid)[0][0] for resid in
                          run_resids])
         residues = residues[inds]
@@ -919,7 +929,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     contact_path = os.path.abspath(args.contacts)
-    cutoff = args.contacts.split('/')[-1].strip('.pkl').split('_')[-1]
+    cutoff = os.path.splitext(args.contacts)[0].split('/')[-1].split('_')[-1]
 
     ParallelGibbs(contact_path, nproc=args.nproc, ncomp=args.ncomp,
                   niter=args.niter).run(run_resids=args.resid)
@@ -0,0 +1,735 @@
+"""
+Tests for the contact mapping in basicrta.contacts
+"""
+
+import glob
+import os
+import warnings
+
+import numpy as np
+import pytest
+import MDAnalysis as mda
+from MDAnalysis.coordinates.memory import MemoryReader
+from MDAnalysis.lib import distances
+
+from basicrta.gibbs import ParallelGibbs
+from basicrta.contacts import (MapContacts, ProcessContacts, ContactSearch,
+                               load_contacts, load_metadata, merge_shards,
+                               residue_minima, contact_dtype, event_dtype,
+                               extract_positions, positions_universe,
+                               Prefetcher, ChunkScheduler, scratch_dir,
+                               ContactStats, load_stats, save_stats,
+                               build_bits, load_bits, bit_events, bits_dtype,
+                               Refinement, load_occupancy, occupancy_dtype,
+                               compress_contacts, CompressedContacts,
+                               open_residues, load_windows)
+
+
+@pytest.fixture
+def system(tmp_path):
+    """Small protein/lipid system written to disk as a pdb/xtc pair"""
+    rng = np.random.default_rng(7)
+    nprot, nlip, natoms, nframes = 4, 30, 3, 12
+    n = (nprot + nlip) * natoms
+    u = mda.Universe.empty(n, n_residues=nprot + nlip,
+                           atom_resindex=np.repeat(np.arange(nprot + nlip),
+                                                   natoms),
+                           trajectory=True)
+    u.add_TopologyAttr('name', ['CA'] * n)
+    u.add_TopologyAttr('resname', ['ALA'] * nprot + ['CHOL'] * nlip)
+    u.add_TopologyAttr('resid', np.arange(1, nprot + nlip + 1))
+    pos = rng.uniform(0, 30, (nframes, n, 3)).astype(np.float32)
+    u.load_new(pos, format=MemoryReader, dimensions=[30, 30, 30, 90, 90, 90],
+               dt=100)
+
+    top, traj = str(tmp_path / 'system.pdb'), str(tmp_path / 'system.xtc')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        u.atoms.write(top)
+        with mda.Writer(traj, n) as W:
+            for ts in u.trajectory:
+                W.write(u.atoms)
+        return mda.Universe(top, traj)
+
+
+def reference_contacts(u, ag1, ag2, cutoff):
+    """Row-by-row contact map computed with full distance arrays"""
+    rows = []
+    for ts in u.trajectory:
+        d = distances.distance_array(ag1.positions, ag2.positions)
+        for r1 in np.unique(ag1.resids):
+            for r2 in np.unique(ag2.resids):
+                mind = d[ag1.resids == r1][:, ag2.resids == r2].min()
+                if mind <= cutoff:
+                    rows.append([ts.frame, r1, r2, mind, ts.time / 1000])
+    return np.array(rows)
+
+
+def test_residue_minima():
+    rng = np.random.default_rng(0)
+    rinds1 = np.repeat(np.arange(5), 4)
+    rinds2 = np.repeat(np.arange(7), 3)
+    pairs = np.stack([rng.integers(0, 20, 500), rng.integers(0, 21, 500)],
+                     axis=1)
+    dists = rng.uniform(0, 10, 500)
+
+    r1, r2, mind = residue_minima(pairs, dists, rinds1, rinds2, 7)
+    expected = {}
+    for (a, b), d in zip(pairs, dists):
+        key = (rinds1[a], rinds2[b])
+        expected[key] = min(d, expected.get(key, np.inf))
+
+    assert sorted(expected) == list(zip(r1, r2))
+    assert np.allclose([expected[k] for k in zip(r1, r2)], mind)
+
+
+def test_residue_minima_empty():
+    r1, r2, mind = residue_minima(np.empty((0, 2), dtype=np.int64),
+                                  np.empty(0), np.arange(3), np.arange(3), 3)
+    assert len(r1) == len(r2) == len(mind) == 0
+
+
+@pytest.mark.parametrize('skin', [None, 2.0])
+def test_contact_search_backends(skin):
+    pytest.importorskip('numba')
+    rng = np.random.default_rng(4)
+    pos1 = rng.uniform(40, 60, (60, 3)).astype(np.float32)
+    pos2 = rng.uniform(30, 70, (1500, 3)).astype(np.float32)
+    resids1 = np.repeat(np.arange(1, 21), 3)
+    resids2 = rng.permutation(np.repeat(np.arange(100, 600), 3))
+
+    numpy = ContactSearch(resids1, resids2, 6.0, skin=skin, backend='numpy')
+    numba = ContactSearch(resids1, resids2, 6.0, skin=skin, backend='numba')
+    for frame in range(5):
+        pos2 = pos2 + rng.normal(0, 0.2, pos2.shape).astype(np.float32)
+        expected, rows = numpy.rows(pos1, pos2), numba.rows(pos1, pos2)
+        for name in ['presid', 'lresid', 'distance']:
+            assert np.array_equal(expected[name], rows[name])
+    assert len(numba.rows(pos1, pos2 + 1000)) == 0
+
+
+@pytest.mark.parametrize('prefilter', [True, False])
+@pytest.mark.parametrize('shuffle', [True, False])
+def test_contact_search(prefilter, shuffle):
+    rng = np.random.default_rng(1)
+    pos1 = rng.uniform(40, 60, (60, 3)).astype(np.float32)
+    pos2 = (np.repeat(rng.uniform(0, 100, (1000, 3)), 3, axis=0) +
+            rng.normal(0, 1, (3000, 3))).astype(np.float32)
+    resids1 = np.repeat(np.arange(1, 21), 3)
+    resids2 = np.repeat(np.arange(100, 1100), 3)
+    if shuffle:
+        resids2 = rng.permutation(resids2)
+
+    search = ContactSearch(resids1, resids2, 6.0, prefilter=prefilter)
+    presid, lresid, mind = search.run(pos1, pos2)
+    d = distances.distance_array(pos1, pos2)
+    expected = [(r1, r2, d[resids1 == r1][:, resids2 == r2].min())
+                for r1 in np.unique(resids1) for r2 in np.unique(resids2)]
+    expected = np.array([row for row in expected if row[2] <= 6.0])
+    assert np.array_equal(presid, expected[:, 0])
+    assert np.array_equal(lresid, expected[:, 1])
+    assert np.allclose(mind, expected[:, 2])
+
+
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_contact_search_skin(prefilter):
+    rng = np.random.default_rng(2)
+    pos1 = rng.uniform(40, 60, (60, 3)).astype(np.float32)
+    pos2 = rng.uniform(30, 70, (600, 3)).astype(np.float32)
+    resids1 = np.repeat(np.arange(1, 21), 3)
+    resids2 = np.repeat(np.arange(100, 300), 3)
+
+    search = ContactSearch(resids1, resids2, 6.0, prefilter=prefilter)
+    verlet = ContactSearch(resids1, resids2, 6.0, prefilter=prefilter,
+                           skin=2.0)
+    for frame in range(20):
+        pos2 = pos2 + rng.normal(0, 0.2, pos2.shape).astype(np.float32)
+        for a, b in zip(search.run(pos1, pos2), verlet.run(pos1, pos2)):
+            assert np.allclose(a, b)
+    assert 1 < verlet.nbuilds < 20
+
+
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_contact_search_threads(prefilter):
+    rng = np.random.default_rng(3)
+    pos1 = rng.uniform(40, 60, (60, 3)).astype(np.float32)
+    pos2 = rng.uniform(30, 70, (1500, 3)).astype(np.float32)
+    resids1 = np.repeat(np.arange(1, 21), 3)
+    resids2 = rng.permutation(np.repeat(np.arange(100, 600), 3))
+
+    search = ContactSearch(resids1, resids2, 6.0, prefilter=prefilter)
+    threaded = ContactSearch(resids1, resids2, 6.0, prefilter=prefilter,
+                             nthreads=4)
+    presid, lresid, mind = search.run(pos1, pos2)
+    tpresid, tlresid, tmind = threaded.run(pos1, pos2)
+    threaded.close()
+    assert np.array_equal(presid, tpresid)
+    assert np.array_equal(lresid, tlresid)
+    assert np.allclose(mind, tmind)
+
+
+@pytest.mark.parametrize('depth', [0, 1, 3])
+def test_prefetcher(depth):
+    def frames():
+        for i in range(20):
+            yield i
+        raise RuntimeError('unreadable frame')
+
+    reader, items = Prefetcher(frames(), depth), []
+    with pytest.raises(RuntimeError):
+        for item in reader:
+            items.append(item)
+    assert items == list(range(20))
+    assert reader.wait >= 0
+    assert next(iter(Prefetcher(range(5), depth))) == 0
+
+
+def test_chunk_scheduler():
+    scheduler = ChunkScheduler([(0, 10), (20, 1000)], nproc=2, target=1.0,
+                               max_size=200, first_size=4)
+    chunks = [scheduler.next()]
+    assert chunks[0] == (0, 4)
+    # 50 frames/s with a 1 s target
+    scheduler.record(10, 0.2)
+    while chunks[-1] is not None:
+        chunks.append(scheduler.next())
+    chunks = chunks[:-1]
+
+    assert chunks[1] == (4, 10)
+    assert chunks[2] == (20, 70)
+    frames = np.concatenate([np.arange(*chunk) for chunk in chunks])
+    assert np.array_equal(frames, np.r_[0:10, 20:1000])
+    sizes = [stop - start for start, stop in chunks]
+    assert max(sizes) <= 200
+    assert sizes[-1] == 1
+    assert scheduler.remaining == 0
+
+
+@pytest.mark.parametrize('prefilter', [True, False])
+def test_map_contacts(system, tmp_path, monkeypatch, prefilter):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3,
+                prefilter=prefilter).run()
+
+    contacts = load_contacts('contacts.npy')
+    metadata = load_metadata('contacts.npy')
+    assert metadata == contacts.dtype.metadata
+    assert metadata['cutoff'] == 6.0
+    assert metadata['ag1_indices'] == ag1.indices.tolist()
+    assert metadata['ag2_indices'] == ag2.indices.tolist()
+    assert metadata['traj'] == system.trajectory.filename
+    ref = reference_contacts(system, ag1, ag2, 6.0)
+    assert contacts.dtype.names == contact_dtype.names
+    contacts = np.sort(np.array(contacts), order=['frame', 'presid',
+                                                  'lresid'])
+    assert len(contacts) == len(ref)
+    for k, name in enumerate(['frame', 'presid', 'lresid', 'distance',
+                              'time']):
+        assert np.allclose(contacts[name], ref[:, k], atol=1e-4)
+    assert (contacts['replica'] == 0).all()
+
+
+def test_map_contacts_positions(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    extract_positions(system, ag1, ag2, store_name='positions.npy')
+
+    stored = positions_universe('positions.npy')
+    assert len(stored.atoms) == len(ag1) + len(ag2)
+    assert np.array_equal(stored.residues.resids,
+                          (ag1 + ag2).residues.resids)
+    for ts, sts in zip(system.trajectory, stored.trajectory):
+        assert np.array_equal(sts.positions, (ag1 + ag2).positions)
+        assert np.allclose(sts.dimensions, ts.dimensions)
+        assert sts.time == pytest.approx(ts.time)
+
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3).run()
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3,
+                positions='positions.npy', prefetch=0,
+                map_name='stored.npy').run()
+    assert np.array_equal(np.load('contacts.npy'), np.load('stored.npy'))
+
+    other = system.select_atoms('resname CHOL and resid 10-20')
+    with pytest.raises(ValueError):
+        MapContacts(system, ag1, other, positions='positions.npy').run()
+
+
+def test_map_contacts_species(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = [system.select_atoms('resname CHOL and resid 5-20'),
+           system.select_atoms('resname CHOL and resid 21-34')]
+    extract_positions(system, ag1, ag2[0] + ag2[1], store_name='positions.npy')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=[6.0, 5.0], nslices=3,
+                positions='positions.npy').run()
+
+    for k, cutoff in enumerate([6.0, 5.0]):
+        MapContacts(system, ag1, ag2[k], nproc=2, cutoff=cutoff, nslices=3,
+                    map_name='single.npy').run()
+        assert (load_metadata(f'contacts.{k}.npy') ==
+                load_metadata('single.npy'))
+        assert np.array_equal(np.load(f'contacts.{k}.npy'),
+                              np.load('single.npy'))
+    assert not glob.glob('.contacts*')
+
+
+@pytest.mark.parametrize('cutoff', [6.0, 5.0])
+def test_map_contacts_resume(system, tmp_path, monkeypatch, cutoff):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    # leave behind the manifest, one committed and one partial chunk of a 6.0
+    # run
+    interrupted = MapContacts(system, ag1, ag2, cutoff=6.0, nslices=3)
+    os.makedirs(scratch_dir('contacts.npy'))
+    interrupted._completed_chunks(np.arange(12))
+    np.zeros(1, dtype=contact_dtype).tofile(interrupted._slice_name((4, 8)))
+    ContactStats(np.unique(ag1.resids)).save(
+        f'{interrupted._slice_name((4, 8))}.stats.npz')
+    np.save(f'{interrupted._slice_name((4, 8))}.occupancy.npy',
+            np.zeros(4, dtype=occupancy_dtype(len(np.unique(ag1.resids)))))
+    np.zeros(1, dtype=contact_dtype).tofile(
+        f'{interrupted._slice_name((8, 10))}.part')
+
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=cutoff, nslices=3).run()
+    contacts = load_contacts('contacts.npy')
+    ref = reference_contacts(system, ag1, ag2, cutoff)
+    frames = np.unique(ref[:, 0][(ref[:, 0] >= 4) & (ref[:, 0] < 8)])
+    if cutoff == 6.0:
+        # the committed chunk is reused instead of computing frames 4-7
+        assert np.isin(frames, contacts['frame'], invert=True).all()
+        assert len(contacts) == len(ref) - np.isin(ref[:, 0], frames).sum() + 1
+    else:
+        assert len(contacts) == len(ref)
+    assert not glob.glob('.contacts*')
+
+
+def test_map_contacts_scratch(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('scratch')
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3,
+                scratch='scratch').run()
+    assert not os.listdir('scratch')
+    assert not glob.glob('.contacts*')
+
+    # a failed run only leaves its chunks behind if it can be resumed
+    monkeypatch.setattr(MapContacts, '_assemble', None)
+    for resume in [True, False]:
+        with pytest.raises(TypeError):
+            MapContacts(system, ag1, ag2, cutoff=6.0, nslices=3,
+                        map_name='failed.npy', scratch='scratch',
+                        resume=resume).run()
+        assert bool(os.listdir('scratch')) == resume
+
+    ProcessContacts(6.0, 2, scratch='scratch').run()
+    assert os.listdir('scratch') == []
+    assert os.path.exists('contacts_6.0.npy')
+
+
+def test_map_contacts_append(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=3,
+                frames=np.arange(7)).run()
+    assert load_metadata('contacts.npy')['last_frame'] == 6
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3,
+                append=True).run()
+
+    contacts = load_contacts('contacts.npy')
+    assert load_metadata('contacts.npy')['last_frame'] == 11
+    ref = reference_contacts(system, ag1, ag2, 6.0)
+    assert len(contacts) == len(ref)
+    assert np.array_equal(contacts['frame'], np.sort(ref[:, 0]))
+
+    with pytest.raises(ValueError, match='cutoff'):
+        MapContacts(system, ag1, ag2, cutoff=5.0, append=True).run()
+    with pytest.raises(ValueError, match='ag2_indices'):
+        MapContacts(system, ag1, ag2[:-3], cutoff=6.0, append=True).run()
+
+    # unrefined frames would hide that the map is only exact at its cutoff
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=1, refine=4,
+                frames=np.arange(7), map_name='refined.npy').run()
+    with pytest.raises(ValueError, match='refine'):
+        MapContacts(system, ag1, ag2, cutoff=6.0, append=True,
+                    map_name='refined.npy').run()
+    assert load_metadata('refined.npy')['refine'] == 4
+
+
+def test_merge_shards(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    for start, stop in [(5, 12), (0, 3), (3, 5)]:
+        MapContacts(system, ag1, ag2, cutoff=6.0, nslices=2,
+                    frames=np.arange(start, stop),
+                    map_name=f'contacts.shard_{start}.npy').run()
+    merge_shards(['contacts.shard_5.npy', 'contacts.shard_0.npy',
+                  'contacts.shard_3.npy'], chunksize=7)
+
+    contacts = load_contacts('contacts.npy')
+    ref = reference_contacts(system, ag1, ag2, 6.0)
+    assert np.array_equal(contacts['frame'], np.sort(ref[:, 0]))
+    assert contacts.dtype.metadata['first_frame'] == 0
+    assert contacts.dtype.metadata['last_frame'] == 11
+    MapContacts(system, ag1, ag2, cutoff=6.0, map_name='full.npy').run()
+    assert np.array_equal(load_stats('contacts.npy'), load_stats('full.npy'))
+    assert np.array_equal(load_occupancy('contacts.npy'),
+                          load_occupancy('full.npy'))
+
+    with pytest.raises(ValueError, match='not contiguous'):
+        merge_shards(['contacts.shard_0.npy', 'contacts.shard_5.npy'],
+                     map_name='gap.npy')
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=1, refine=2,
+                frames=np.arange(3), map_name='refined.npy').run()
+    with pytest.raises(ValueError, match='refine'):
+        merge_shards(['refined.npy', 'contacts.shard_3.npy'],
+                     map_name='mixed.npy')
+
+
+def test_process_contacts(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3).run()
+    ProcessContacts(5.0, 2).run()
+
+    contacts = load_contacts('contacts_5.0.npy')
+    assert contacts.dtype.metadata['ts'] == pytest.approx(0.1)
+    ref = reference_contacts(system, ag1, ag2, 5.0)
+    assert contacts.dtype.names == event_dtype.names
+    # every frame in contact is accounted for by exactly one residence event
+    assert contacts['nframes'].sum() == len(ref)
+    for event in contacts:
+        frames = ref[(ref[:, 1] == event['presid']) &
+                     (ref[:, 2] == event['lresid'])][:, 0]
+        assert np.isin(np.arange(event['frame'],
+                                 event['frame'] + event['nframes']),
+                       frames).all()
+        assert event['frame'] - 1 not in frames
+        assert event['frame'] + event['nframes'] not in frames
+    assert not glob.glob('.contacts*')
+    # contacts beyond the cutoff of the map were never recorded
+    with pytest.raises(ValueError):
+        ProcessContacts(7.0, 2).run()
+
+
+def test_contact_stats(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=4).run()
+    ProcessContacts(6.0, 2).run()
+    stats = load_stats('contacts.npy')
+    events = load_contacts('contacts_6.0.npy')
+    ref = reference_contacts(system, ag1, ag2, 6.0)
+
+    assert stats.dtype.metadata['nframes'] == 12
+    assert np.array_equal(stats['presid'], np.unique(ag1.resids))
+    for row in stats:
+        rows = ref[ref[:, 1] == row['presid']]
+        assert row['nevents'] == (events['presid'] == row['presid']).sum()
+        assert row['nframes'] == len(np.unique(rows[:, 0]))
+        assert row['occupancy'] == pytest.approx(row['nframes'] / 12)
+        assert row['ncontacts'] == len(rows)
+        assert row['contact_time'] == pytest.approx(len(rows) * 0.1)
+    assert np.array_equal(load_stats('contacts_6.0.npy'), stats)
+
+    # counts beyond the precision of float32 times are kept exactly
+    counts = ContactStats(stats['presid'])
+    counts.counts[2] = 2**24 + 1
+    save_stats('large.npy', counts.table(0.1), 12)
+    loaded = ContactStats.from_table(load_stats('large.npy'), 0.1)
+    assert (loaded.counts[2] == 2**24 + 1).all()
+
+    # appended maps continue the statistics, joining events across frames
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=3, frames=np.arange(7),
+                map_name='appended.npy').run()
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=3, append=True,
+                map_name='appended.npy').run()
+    assert np.array_equal(load_stats('appended.npy'), stats)
+
+
+def test_map_contacts_replicas(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=3,
+                map_name='single.npy').run()
+    ProcessContacts(6.0, 2, map_name='single.npy').run()
+
+    # the same trajectory twice, as two independent replicas
+    traj = system.trajectory.filename
+    replicas = mda.Universe(system.filename, [traj, traj])
+    ag1 = replicas.select_atoms('resname ALA')
+    ag2 = replicas.select_atoms('resname CHOL')
+    MapContacts(replicas, ag1, ag2, nproc=2, cutoff=6.0, nslices=4).run()
+    ProcessContacts(6.0, 2).run()
+
+    contacts = load_contacts('contacts.npy')
+    assert contacts.dtype.metadata['traj'] == [traj, traj]
+    assert contacts.dtype.metadata['replica_starts'] == [0, 12]
+    assert np.array_equal(contacts['replica'], contacts['frame'] >= 12)
+    single = np.load('single.npy')
+    assert len(contacts) == 2 * len(single)
+
+    # no event continues from the last frame of one replica into the next
+    events, single = np.load('contacts_6.0.npy'), np.load('single_6.0.npy')
+    assert len(events) == 2 * len(single)
+    assert np.array_equal(np.bincount(events['replica']),
+                          [len(single), len(single)])
+    stats = load_stats('contacts.npy')
+    assert np.array_equal(stats['nevents'], 2 * load_stats('single.npy')[
+        'nevents'])
+
+
+@pytest.mark.parametrize('replica_starts', [None, [0, 130]])
+def test_bit_events(replica_starts):
+    # pair (1, 10) in contact in frames 3-5 and 60-199 of 200 frames, across
+    # three words, and pair (2, 10) in frame 63 only
+    frames = np.concatenate([np.arange(3, 6), np.arange(60, 200)])
+    words = np.zeros(5, dtype=bits_dtype)
+    words['presid'], words['lresid'] = [1, 1, 1, 1, 2], 10
+    words['word'] = [0, 1, 2, 3, 0]
+    for k in range(4):
+        inword = frames[frames // 64 == k] % 64
+        words['bits'][k] = np.bitwise_or.reduce(
+            np.left_shift(np.uint64(1), inword.astype(np.uint64)))
+    words['bits'][4] = np.uint64(1) << np.uint64(63)
+    times = np.arange(200, dtype=np.float32) / 10
+
+    events = bit_events(words, times, 1000, replica_starts and
+                        [start + 1000 for start in replica_starts])
+    ref = [(1, 1003, 3), (1, 1060, 140), (2, 1063, 1)]
+    if replica_starts:
+        ref[1:2] = [(1, 1060, 70), (1, 1130, 70)]
+    assert [tuple(e) for e in events[['presid', 'frame', 'nframes']]] == ref
+    assert np.allclose(events['time'], (events['frame'] - 1000) / 10)
+    assert (events['replica'] ==
+            (events['frame'] >= 1130 if replica_starts else 0)).all()
+
+
+def test_process_contacts_bits(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    traj = system.trajectory.filename
+    replicas = mda.Universe(system.filename, [traj, traj])
+    ag1 = replicas.select_atoms('resname ALA')
+    ag2 = replicas.select_atoms('resname CHOL')
+    MapContacts(replicas, ag1, ag2, nproc=2, cutoff=6.0, nslices=4).run()
+    build_bits('contacts.npy', 6.0)
+    words, times, metadata = load_bits('contacts_6.0.bits.npz')
+    assert metadata['bits_cutoff'] == 6.0
+    assert len(words) < len(np.load('contacts.npy'))
+
+    ProcessContacts(6.0, 2).run()
+    events = np.load('contacts_6.0.npy')
+    stats = load_stats('contacts_6.0.npy')
+    # the same events as found from the rows of the map
+    os.remove('contacts_6.0.bits.npz')
+    ProcessContacts(6.0, 2).run()
+    assert np.array_equal(events, np.load('contacts_6.0.npy'))
+    assert np.array_equal(stats, load_stats('contacts_6.0.npy'))
+
+    build_bits('contacts.npy', 4.5)
+    ProcessContacts(4.5, 2).run()
+    events = np.load('contacts_4.5.npy')
+    os.remove('contacts_4.5.bits.npz')
+    ProcessContacts(4.5, 2).run()
+    assert np.array_equal(events, np.load('contacts_4.5.npy'))
+    with pytest.raises(ValueError):
+        build_bits('contacts.npy', 7.0)
+
+
+@pytest.mark.parametrize('transients', [None, 5.0])
+def test_refinement(transients):
+    # lipid 10 in contact with residue 1 in frames 0-10, 19-21 and 31-33,
+    # lipid 11 in frames 20-49, a step of at most 2 A per frame
+    inside = np.zeros((2, 50), dtype=bool)
+    inside[0, np.r_[0:11, 19:22, 31:34]] = True
+    inside[1, 20:] = True
+    x = np.where(inside, 4.0, 8.0)
+    pos2 = np.zeros((50, 2, 3), dtype=np.float32)
+    pos2[:, :, 0] = x.T
+
+    def read(frames):
+        for frame in frames:
+            yield frame, frame * 10.0, np.zeros((1, 3), dtype=np.float32), \
+                [pos2[frame]]
+
+    search = ContactSearch([1], [10, 11], 5.0 + (transients or 0))
+    refinement = Refinement(np.arange(50), [search], [5.0], 8,
+                            transients=transients, read=read)
+    frames = list(refinement)
+    assert [frame for frame, _, _ in frames] == list(range(50))
+    assert np.allclose([time for _, time, _ in frames],
+                       np.arange(50) * 10.0)
+    found = np.zeros((2, 50), dtype=bool)
+    for frame, _, (rows,) in frames:
+        found[rows['lresid'] - 10, frame] = True
+        assert np.allclose(rows['distance'], 4.0)
+    if transients is None:
+        # the short event between the samples at frames 16 and 24 is missed
+        inside[0, 19:22] = False
+    assert np.array_equal(found, inside)
+
+
+def test_map_contacts_refine(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=1,
+                map_name='full.npy').run()
+    full = np.load('full.npy')
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=1, refine=4,
+                transients=50.0).run()
+    refined = load_contacts('contacts.npy')
+    assert refined.dtype.metadata['refine'] == 4
+    # every pair is checked in every frame with a wide enough margin
+    order = np.lexsort((refined['lresid'], refined['presid'],
+                        refined['frame']))
+    for name in ['frame', 'presid', 'lresid', 'time']:
+        assert np.array_equal(refined[name][order], full[name])
+    assert np.allclose(refined['distance'][order], full['distance'],
+                       atol=1e-4)
+    # contacts between samples are only refined at the cutoff of the map
+    with pytest.raises(ValueError):
+        ProcessContacts(5.0, 1).run()
+
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=1, refine=4).run()
+    refined = np.load('contacts.npy')
+    # the sampled frames are searched in full
+    sampled = [np.sort(contacts[np.isin(contacts['frame'], [0, 4, 8, 11])][
+        ['frame', 'presid', 'lresid']]) for contacts in [refined, full]]
+    assert np.array_equal(*sampled)
+
+
+def test_occupancy(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=4,
+                frames=np.arange(8)).run()
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=2, append=True).run()
+    occupancy = load_occupancy('contacts.npy')
+    contacts = np.load('contacts.npy')
+    resids = np.unique(ag1.resids)
+
+    assert occupancy.dtype.metadata['resids'] == resids.tolist()
+    assert np.array_equal(occupancy['frame'], np.arange(12))
+    for frame, nlipids in occupancy:
+        rows = contacts[contacts['frame'] == frame]
+        assert np.array_equal(nlipids, [(rows['presid'] == resid).sum() for
+                                        resid in resids])
+
+
+def test_compress_contacts(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3).run()
+    ProcessContacts(5.0, 2).run()
+    contacts = np.load('contacts.npy')
+    events = np.load('contacts_5.0.npy')
+
+    compress_contacts('contacts.npy', chunksize=100)
+    store = CompressedContacts('contacts.compressed.bin')
+    assert len(store) == len(contacts)
+    assert store.metadata['cutoff'] == 6.0
+    assert np.array_equal(store.resids, np.unique(contacts['presid']))
+    for presid in store.resids:
+        # rows of a residue are split over several blocks
+        assert np.array_equal(store.residue(presid),
+                              contacts[contacts['presid'] == presid])
+    assert len(store.residue(-1)) == 0
+    with pytest.raises(ImportError):
+        compress_contacts('contacts.npy', codec='lzma')
+
+    # events are found residue by residue once the map is removed
+    os.remove('contacts.npy')
+    ProcessContacts(5.0, 2).run()
+    assert np.array_equal(np.load('contacts_5.0.npy'), events)
+    assert not glob.glob('.contacts*')
+
+    compress_contacts('contacts_5.0.npy')
+    residues = open_residues('contacts_5.0.npy')
+    assert isinstance(residues, CompressedContacts)
+    assert np.array_equal(residues.residue(store.resids[0]),
+                          events[events['presid'] == store.resids[0]])
+    # a map written after its compressed copy is read instead
+    np.save('contacts_5.0.npy', events[:-1])
+    assert not isinstance(open_residues('contacts_5.0.npy'),
+                          CompressedContacts)
+
+
+def test_levels(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, nproc=2, cutoff=6.0, nslices=3,
+                levels=[2, 5]).run()
+    contacts = np.load('contacts.npy')
+    occupancy = load_occupancy('contacts.npy')
+
+    level = load_contacts('contacts.level_5.npy')
+    assert np.array_equal(level, contacts[contacts['frame'] % 5 == 0])
+    assert level.dtype.metadata['stride'] == 5
+    assert level.dtype.metadata['ts'] == pytest.approx(0.5)
+    assert level.dtype.metadata['last_frame'] == 10
+
+    windows = load_windows('contacts.npy', 5)
+    assert np.array_equal(windows['frame'], [0, 5, 10])
+    assert np.array_equal(windows['nframes'], [5, 5, 2])
+    nlipids = occupancy['nlipids'][5:10]
+    assert np.allclose(windows['nlipids'][1], nlipids.mean(axis=0))
+    assert np.allclose(windows['occupancy'][1], (nlipids > 0).mean(axis=0))
+
+    ProcessContacts(5.0, 2, levels=[2]).run()
+    events = np.load('contacts.level_2_5.0.npy')
+    rows = np.load('contacts.level_2.npy')
+    rows = rows[rows['distance'] <= 5.0]
+    # every sampled frame in contact is in exactly one event, of samples two
+    # frames apart
+    assert events['nframes'].sum() == len(rows)
+    for event in events:
+        frames = rows['frame'][(rows['presid'] == event['presid']) &
+                               (rows['lresid'] == event['lresid'])]
+        assert np.isin(event['frame'] + 2 * np.arange(event['nframes']),
+                       frames).all()
+        assert event['frame'] - 2 not in frames
+        assert event['frame'] + 2 * event['nframes'] not in frames
+    stats = load_stats('contacts.level_2_5.0.npy')
+    assert stats.dtype.metadata['nframes'] == 6
+
+    # the bit sets of a level give the same events
+    build_bits('contacts.level_2.npy', 5.0)
+    ProcessContacts(5.0, 2, map_name='contacts.level_2.npy').run()
+    assert np.array_equal(np.load('contacts.level_2_5.0.npy'), events)
+
+    # levels are processed as they are once the map is only compressed
+    compress_contacts('contacts.npy')
+    os.remove('contacts.npy')
+    ProcessContacts(5.0, 2, levels=[2, 3]).run()
+    assert np.array_equal(np.load('contacts.level_2_5.0.npy'), events)
+    assert not os.path.exists('contacts.level_3_5.0.npy')
+
+
+def test_levels_gibbs(system, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    ag1 = system.select_atoms('resname ALA')
+    ag2 = system.select_atoms('resname CHOL')
+    MapContacts(system, ag1, ag2, cutoff=6.0, nslices=2, levels=[10]).run()
+    ProcessContacts(6.0, 1, levels=[10]).run()
+    name = 'contacts.level_10_6.0.npy'
+    contacts = open_residues(name)
+    # frames of the level are a whole nanosecond apart
+    assert contacts.metadata['ts'] == pytest.approx(1.0)
+    times = ParallelGibbs(name)._residence_times(contacts, contacts.resids)
+    events = np.load(name)
+    assert len(events) > 0
+    assert np.allclose(np.sort(np.concatenate(times)),
+                       np.sort(events['nframes'] * 1.0))
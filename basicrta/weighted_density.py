@@ -3,28 +3,28 @@ import numpy as np
 import MDAnalysis as mda
 import os
 from tqdm import tqdm
-from basicrta.util import get_start_stop_frames
-import pickle
+from basicrta.contacts import (load_metadata, load_positions, open_residues,
+                               positions_universe)
 # from MDAnalysis.lib.util import realpath
 
 
 class MapKinetics(object):
-    def __init__(self, gibbs, contacts):
+    def __init__(self, gibbs, contacts, positions=None):
         self.gibbs = gibbs
-        self.cutoff = float(contacts.split('/')[-1].strip('.pkl').
+        self.positions = positions
+        self.cutoff = float(os.path.splitext(contacts)[0].split('/')[-1].
                             split('_')[-1])
         self.write_sel = None
         self.contacts = contacts
 
-        with open(contacts, 'rb') as f:
-            tmpcontacts = pickle.load(f)
-        metadata = tmpcontacts.dtype.metadata
-        self.ag1 = metadata['ag1']
-        self.ag2 = metadata['ag2']
+        metadata = load_metadata(contacts)
+        self.ag1_indices = metadata['ag1_indices']
+        self.ag2_indices = metadata['ag2_indices']
         self.ts = metadata['ts']
+        # level maps only hold every `stride`th frame
+        self.stride = metadata.get('stride', 1)
         self.utop = metadata['top']
         self.utraj = metadata['traj']
-        del tmpcontacts
 
         self.dataname = (f'basicrta-{self.cutoff}/{self.gibbs.residue}/'
                          f'den_write_data.npy')
@@ -33,23 +33,44 @@ class MapKinetics(object):
         self.fulltraj = (f'basicrta-{self.cutoff}/{self.gibbs.residue}/'
                          f'chol_traj_all.xtc')
 
+    def _stored_groups(self, u):
+        """
+        Atom groups of the contact map in the universe of the position store,
+        which holds the atoms of ag1 followed by the second atom groups of
+        every selection mapped along with this one.
+        """
+        stored = load_positions(self.positions).dtype.metadata
+        mapped = {'top': self.utop, 'traj': self.utraj,
+                  'ag1_indices': self.ag1_indices}
+        for key, value in mapped.items():
+            if stored[key] != value:
+                raise ValueError(f'Cannot use {self.positions}, "{key}" '
+                                 'differs from the contact map')
+        stored_ag2 = np.asarray(stored['ag2_indices'])
+        ag2_indices = np.asarray(self.ag2_indices)
+        if not np.isin(ag2_indices, stored_ag2).all():
+            raise ValueError(f'Cannot use {self.positions}, it does not hold '
+                             'every atom of ag2 of the contact map')
+        order = np.argsort(stored_ag2)
+        ag2_positions = order[np.searchsorted(stored_ag2[order], ag2_indices)]
+        ag1 = u.atoms[:len(self.ag1_indices)]
+        ag2 = u.atoms[len(self.ag1_indices) + ag2_positions]
+        return ag1, ag2
+
     def _create_data(self):
         from numpy.lib.format import open_memmap
-        with open(self.contacts, 'rb') as f:
-            contacts = pickle.load(f)
-
         resid = int(self.gibbs.residue[1:])
         ncomp = self.gibbs.processed_results.ncomp
 
-        times = np.array(contacts[contacts[:, 0] == resid][:, 3])
-        trajtimes = np.array(contacts[contacts[:, 0] == resid][:, 2])
-        lipinds = np.array(contacts[contacts[:, 0] == resid][:, 1])
-        del contacts
+        events = open_residues(self.contacts).residue(resid)
+        lipinds = events['lresid']
 
         indicators = self.gibbs.processed_results.indicator
 
-        bframes, eframes = get_start_stop_frames(trajtimes, times, self.ts)
-        tmplens = [len(np.arange(b, e)) for b, e in zip(bframes, eframes)]
+        bframes = events['frame']
+        eframes = bframes + events['nframes'] * self.stride
+        tmplens = [len(np.arange(b, e, self.stride)) for b, e in
+                   zip(bframes, eframes)]
         totlen = sum(tmplens)
         write_data = open_memmap(self.dataname, mode='w+', dtype=np.float64,
                                  shape=(totlen, ncomp+2))
@@ -57,9 +78,9 @@ class MapKinetics(object):
         j = 0
         for b, e, l, i in tqdm(zip(bframes, eframes, lipinds, indicators),
                                total=len(bframes)):
-            tmp = np.arange(b, e)
-            tmpl = np.ones_like(np.arange(b, e)) * l
-            tmpi = i * np.ones((len(np.arange(b, e)), ncomp))
+            tmp = np.arange(b, e, self.stride)
+            tmpl = np.ones_like(tmp) * l
+            tmpi = i * np.ones((len(tmp), ncomp))
 
             write_data[j:j+len(tmp), 0] = tmp
             write_data[j:j+len(tmp), 1] = tmpl
@@ -70,15 +91,19 @@ class MapKinetics(object):
         if os.path.exists(self.fulltraj) and top_n is None:
             raise FileExistsError(f'{self.fulltraj} exists, remove then rerun')
 
-        write_ag = self.ag1.atoms + self.ag2.residues[0].atoms
+        if self.positions is not None:
+            u = positions_universe(self.positions)
+            ag1, ag2 = self._stored_groups(u)
+        else:
+            u = mda.Universe(self.utop, self.utraj)
+            ag1 = u.atoms[self.ag1_indices]
+            ag2 = u.atoms[self.ag2_indices]
+        write_ag = ag1.atoms + ag2.residues[0].atoms
         write_ag.atoms.write(self.topname)
         if not os.path.exists(self.dataname):
             self._create_data()
 
         tmp = np.load(self.dataname, mmap_mode='r')
-        u = mda.Universe(f'{self.utop}', f'{self.utraj}')
-        ag1 = u.atoms[self.ag1.indices]
-        ag2 = u.atoms[self.ag2.indices]
         if top_n is not None:
             sortinds = [tmp[:, i+2].argsort()[::-1][:top_n] for i in
                         range(self.gibbs.processed_results.ncomp)]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Benchmark the backends reducing atom pairs to residue pairs in
+basicrta.contacts.ContactSearch, on a synthetic protein embedded in a
+membrane of lipids.
+
+    python devtools/scripts/benchmark_contacts.py --nlipids 20000
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+from MDAnalysis.lib import distances
+
+from basicrta.contacts import (ContactSearch, contact_dtype, njit,
+                               residue_minima, _residue_minima_rows)
+
+
+def system(nprot, nlip, natoms, seed=0):
+    rng = np.random.default_rng(seed)
+    side = np.sqrt(nlip) * 8.0
+    centers = np.column_stack([rng.uniform(0, side, (nlip, 2)),
+                               rng.normal(0, 2, nlip)])
+    pos2 = (np.repeat(centers, natoms, axis=0) +
+            rng.normal(0, 1.5, (nlip * natoms, 3))).astype(np.float32)
+    pos1 = (rng.normal(0, 15, (nprot * 8, 3)) +
+            [side / 2, side / 2, 0]).astype(np.float32)
+    resids1 = np.repeat(np.arange(1, nprot + 1), 8)
+    resids2 = np.repeat(np.arange(nprot + 1, nprot + nlip + 1), natoms)
+    return pos1, pos2, resids1, resids2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--nprot', type=int, default=300)
+    parser.add_argument('--nlipids', type=int, default=20000)
+    parser.add_argument('--natoms', type=int, default=10)
+    parser.add_argument('--cutoff', type=float, default=10.0)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    pos1, pos2, resids1, resids2 = system(args.nprot, args.nlipids,
+                                          args.natoms)
+    ures1, rinds1 = np.unique(resids1, return_inverse=True)
+    ures2, rinds2 = np.unique(resids2, return_inverse=True)
+    pairs, dists = distances.capped_distance(pos1, pos2, args.cutoff)
+    print(f'{len(pos1) + len(pos2)} atoms, {len(pairs)} atom pairs within '
+          f'{args.cutoff} A')
+
+    def numpy():
+        r1, r2, mind = residue_minima(pairs, dists, rinds1, rinds2,
+                                      len(ures2))
+        rows = np.empty(len(mind), dtype=contact_dtype)
+        rows['presid'], rows['lresid'] = ures1[r1], ures2[r2]
+        rows['distance'] = mind
+
+    rows = np.empty(len(pairs), dtype=contact_dtype)
+
+    def numba():
+        _residue_minima_rows(pairs, dists, rinds1, rinds2, len(ures2), ures1,
+                             ures2, rows['presid'], rows['lresid'],
+                             rows['distance'])
+
+    backends = ['numpy'] + (['numba'] if njit is not None else [])
+    if njit is None:
+        print('numba is not installed, only timing the numpy backend')
+    else:
+        numba()  # compile outside of the timings
+
+    timings = {'numpy': numpy, 'numba': numba}
+    for backend in backends:
+        best = min(timeit.repeat(timings[backend], number=1,
+                                 repeat=args.repeat))
+        print(f'{backend:>6} reduction: {best * 1000:8.2f} ms per frame')
+
+    for backend in backends:
+        search = ContactSearch(resids1, resids2, args.cutoff, backend=backend)
+        search.rows(pos1, pos2)
+        best = min(timeit.repeat(lambda: search.rows(pos1, pos2), number=1,
+                                 repeat=args.repeat))
+        print(f'{backend:>6} full search: {best * 1000:8.2f} ms per frame')
+
+
+if __name__ == '__main__':
+    main()